@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''qulab.waveform 的性能测试
+
+在不同的采样点数下测量典型波形 generateData 的耗时、吞吐量与内存峰值，
+结果保存为 JSON，可与以前的结果比较以发现性能退化。
+
+    python benchmarks/bench_waveform.py --save result.json
+    python benchmarks/bench_waveform.py --compare result.json --threshold 1.25
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from qulab.waveform import DC, Cos, Gaussian, Interpolation, Step
+
+SAMPLE_RATE = 1e9
+
+
+def concat(T):
+    '''100 段高斯脉冲与等待时间首尾相接'''
+    n = 100
+    pulse = Gaussian(0.2*T/n) | DC(0, 0.8*T/n)
+    wav = pulse
+    for i in range(n-1):
+        wav = wav | (0.01*i * pulse)
+    return wav
+
+
+def repeat(T):
+    '''1000 个脉冲的重复'''
+    return (Gaussian(0.2*T/1000) | DC(0.5, 0.8*T/1000)) ^ 1000
+
+
+def readout(T):
+    '''10 个频率的复用读取脉冲'''
+    env = Step(T/100) - (Step(T/100) >> 0.8*T)
+    return env * sum(0.1 * Cos(2*np.pi*(6.5e9 + 20e6*i), i) for i in range(10))
+
+
+def interpolation(T):
+    '''长度为 1e4 的插值表，线性与三次样条各一段'''
+    x = np.linspace(0, T/2, 10000)
+    y = np.sin(2*np.pi*x*10/T) * np.exp(-x/T)
+    return Interpolation(x, y) | Interpolation(x, y, 'cubic')
+
+
+def shifted(T):
+    '''50 个平移后的调制高斯脉冲之和'''
+    return sum((Gaussian(T/100) >> (i+0.5)*T/50) * Cos(2*np.pi*100e6, i) for i in range(50))
+
+
+WORKLOADS = [concat, repeat, readout, interpolation, shifted]
+
+
+def run(sizes, repeats=3):
+    results = {}
+    for make in WORKLOADS:
+        for size in sizes:
+            T = size / SAMPLE_RATE
+            wav = make(T).set_range(0, T)
+            times = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                wav.generateData(SAMPLE_RATE, cache=False)
+                times.append(time.perf_counter() - start)
+            tracemalloc.start()
+            wav.generateData(SAMPLE_RATE, cache=False)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            t = min(times)
+            results['%s/%d' % (make.__name__, size)] = {
+                'samples': size,
+                'time': t,
+                'throughput': size / t,
+                'peak_memory': peak,
+            }
+            print('%-14s %9d  %10.3f ms  %9.3g S/s  %8.2f MB' % (
+                make.__name__, size, t*1e3, size/t, peak/2**20))
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''返回耗时或内存峰值超过基准 threshold 倍的项目'''
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        for field in ['time', 'peak_memory']:
+            if b[field] > 0 and r[field] > threshold * b[field]:
+                regressions.append((key, field, b[field], r[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark qulab.waveform rendering.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e3, 1e4, 1e5, 1e6, 1e7])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    results = run([int(s) for s in args.sizes], args.repeats)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for key, field, old, new in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (x%.2f)' % (key, field, old, new, new/old))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
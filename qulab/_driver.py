@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import contextlib
 import copy
+import functools
 import importlib
 import logging
 import os
 import re
 import string
+import time
 
 import numpy as np
 import quantities as pq
 import visa
 
-from .util import IEEE_488_2_BinBlock, get_unit_prefix
+from .util import (IEEE_488_2_block_size, IEEE_488_2_decode, IEEE_488_2_encode,
+                   get_unit_prefix)
 
 log = logging.getLogger('qulab.driver')
 log.addHandler(logging.NullHandler())
@@ -22,6 +28,10 @@ __all__ = [
 
 
 class Quantity:
+    # _parseReply(reply) 将 get_cmd 的回复转换为值，结果与 getValue 相同，
+    # 供 BaseDriver.getValues 合并查询时使用；为 None 的类型不能合并查询
+    _parseReply = None
+
     def __init__(self,
                  name,
                  value=None,
@@ -93,6 +103,10 @@ class QReal(Quantity):
             self.value = res[0]
         return self.value
 
+    def _parseReply(self, reply):
+        self.value = float(reply.split(',')[0])
+        return self.value
+
 
 class QInteger(QReal):
     def __init__(self,
@@ -118,6 +132,9 @@ class QInteger(QReal):
         super(QInteger, self).getValue(ch=ch, **kw)
         return int(self.value)
 
+    def _parseReply(self, reply):
+        return int(super(QInteger, self)._parseReply(reply))
+
 
 class QString(Quantity):
     def __init__(self, name, value=None, ch=None, get_cmd='', set_cmd=''):
@@ -133,6 +150,10 @@ class QString(Quantity):
             self.value = res.strip("\n\"' ")
         return self.value
 
+    def _parseReply(self, reply):
+        self.value = reply.strip("\n\"' ")
+        return self.value
+
 
 class QOption(QString):
     def __init__(self,
@@ -199,6 +220,9 @@ class QBool(QInteger):
             ch = self.ch
         return bool(super(QBool, self).getValue(ch=ch, **kw))
 
+    def _parseReply(self, reply):
+        return bool(super(QBool, self)._parseReply(reply))
+
 
 class QVector(Quantity):
     def __init__(self,
@@ -217,7 +241,7 @@ class QVector(Quantity):
         if self.driver is not None and self.get_cmd is not '':
             cmd = self._formatGetCmd(ch=ch, **kw)
             if kw.get('binary'):
-                res = self.driver.query_binary_values(cmd)
+                res = self.driver.query_binary_values(cmd, container=np.array)
             else:
                 res = self.driver.query_ascii_values(cmd)
             self.value = np.asarray(res)
@@ -248,6 +272,23 @@ class BaseDriver:
     quants = []
     """"""
 
+    cache_set_values = True
+    """Skip setValue when the quantity already holds the value."""
+
+    max_message_length = 4096
+    """Maximum length of a message that joins several commands."""
+
+    chain_queries = True
+    """Whether getValues may join several queries into one message."""
+
+    command_separator = ';:'
+    """Separator that joins commands in batch() and getValues.
+
+    The SCPI default ';:' restarts every command from the root. None means the
+    instrument can not take several commands in one message: batch() sends
+    commands as they come and getValues reads quantities one by one.
+    """
+
     def __init__(self, ins=None, addr=None, model=None, timeout=3, **kw):
         self.addr = addr
         self.ins = ins
@@ -256,6 +297,12 @@ class BaseDriver:
             self.ins.timeout = timeout * 1000
         self.quantities = {}
         self.model = model
+        # (name, 格式化参数) -> 最近一次成功设置到仪器上的值
+        self._set_cache = {}
+        # batch() 中暂存的命令
+        self._batch = None
+        # 异步接口使用的单线程执行器，同一仪器的操作依次执行
+        self._executor = None
 
         for q in self.quants:
             self._add_quant(q)
@@ -289,8 +336,71 @@ class BaseDriver:
             if code == 0:
                 break
             e.append((code, msg))
+        if e:
+            # 出错的命令可能未被执行，仪器的状态不再确定
+            self.invalidate_cache()
         return e
 
+    def invalidate_cache(self, name=None):
+        """清除 setValue 的缓存，name 为 None 时清除全部
+
+        仪器状态被外部改变时（如前面板操作、其他程序）需要调用。
+        """
+        if name is None:
+            self._set_cache.clear()
+        else:
+            for key in [k for k in self._set_cache if k[0] == name]:
+                del self._set_cache[key]
+
+    def _invalidate_on_reset(self, message):
+        if '*RST' in message.upper():
+            self.invalidate_cache()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """在 with 块中暂存 write 的命令，退出时用分号连接成尽量少的消息发送
+
+            with drv.batch():
+                drv.setValue('Frequency', 6e9)
+                drv.setValue('Power', -10)
+
+        每条消息不超过 max_message_length，全部发送后只检查一次错误。块中的查询
+        会先发送已暂存的命令。可以嵌套，由最外层负责发送。command_separator 为
+        None 的仪器不暂存命令，with 块不改变任何行为。
+        """
+        if self._batch is not None or self.command_separator is None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+        finally:
+            self._flush_batch()
+            self._batch = None
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+        cmds, self._batch = self._batch, None
+        messages, message = [], ''
+        for cmd in cmds:
+            cmd = cmd.strip().rstrip(';')
+            if message == '':
+                message = cmd
+                continue
+            if len(message) + len(cmd) + 2 > self.max_message_length:
+                messages.append(message)
+                message = cmd
+            else:
+                message = _join_command(message, cmd, self.command_separator)
+        messages.append(message)
+        try:
+            for message in messages:
+                self.write(message)
+            self.check_errors_and_log('; '.join(messages))
+        finally:
+            self._batch = []
+
     def check_errors_and_log(self, message):
         errs = self.errors()
         for e in errs:
@@ -300,7 +410,9 @@ class BaseDriver:
     def query(self, message, check_errors=False):
         if self.ins is None:
             return None
+        self._flush_batch()
         log.debug("%s << %s", str(self.ins), message)
+        self._invalidate_on_reset(message)
         try:
             res = self.ins.query(message)
         except:
@@ -320,6 +432,7 @@ class BaseDriver:
                            check_errors=False):
         if self.ins is None:
             return None
+        self._flush_batch()
         log.debug("%s << %s", str(self.ins), message)
         try:
             res = self.ins.query_ascii_values(message, converter, separator,
@@ -340,29 +453,58 @@ class BaseDriver:
                             delay=None,
                             header_fmt='ieee',
                             check_errors=False):
+        """container 为 np.array 或 np.ndarray 时直接返回引用接收缓冲区的数组
+
+        只支持 IEEE 488.2 格式的二进制块，header_fmt 为其他值时抛出 ValueError。
+        """
+        if header_fmt != 'ieee':
+            raise ValueError('Unsupported binary header format %r.' % header_fmt)
         if self.ins is None:
             return None
+        self._flush_batch()
         log.debug("%s << %s", str(self.ins), message)
         try:
-            res = self.ins.query_binary_values(
-                message, datatype, is_big_endian, container, delay, header_fmt)
+            self.ins.write(message)
+            if delay:
+                time.sleep(delay)
+            term = (getattr(self.ins, 'read_termination', None) or '').encode()
+            block = bytearray(self.ins.read_raw())
+            # 头部可能分几次才收完；不定长的块 (#0) 由 read_raw 读到结束为止
+            size = IEEE_488_2_block_size(block)
+            while size is None and b'#0' not in block[:64]:
+                block.extend(self.ins.read_raw())
+                size = IEEE_488_2_block_size(block)
+            # 连同其后的结束符一起读完，不影响下一次查询
+            while size is not None and len(block) < size + len(term):
+                block.extend(self.ins.read_raw())
+            res = IEEE_488_2_decode(block, datatype, is_big_endian)
         except:
             log.exception("%s << %s", str(self.ins), message)
             raise
         log.debug("%s >> <%d results>", str(self.ins), len(res))
         if check_errors:
             self.check_errors_and_log(message)
+        if container not in (np.array, np.ndarray):
+            res = container(res)
         return res
 
     def write(self, message, check_errors=False):
         """Send message to the instrument."""
         if self.ins is None:
             return None
+        if self._batch is not None:
+            if not check_errors:
+                self._invalidate_on_reset(message)
+                self._batch.append(message)
+                return self
+            self._flush_batch()
         log.debug("%s << %s", str(self.ins), message)
+        self._invalidate_on_reset(message)
         try:
             ret = self.ins.write(message)
         except:
             log.exception("%s << %s", str(self.ins), message)
+            self.invalidate_cache()
             raise
         if check_errors:
             self.check_errors_and_log(message)
@@ -378,6 +520,7 @@ class BaseDriver:
                            check_errors=False):
         if self.ins is None:
             return None
+        self._flush_batch()
         log_msg = message + ('<%d values>' % len(values))
         log.debug("%s << %s", str(self.ins), log_msg)
         try:
@@ -400,13 +543,18 @@ class BaseDriver:
                             check_errors=False):
         if self.ins is None:
             return None
-        block, header = IEEE_488_2_BinBlock(values, datatype, is_big_endian)
+        self._flush_batch()
+        header, payload = IEEE_488_2_encode(values, datatype, is_big_endian)
+        if termination is None:
+            termination = getattr(self.ins, 'write_termination', None) or ''
+        if encoding is None:
+            encoding = getattr(self.ins, 'encoding', None) or 'ascii'
         log_msg = message + header + '<DATABLOCK>'
         log.debug("%s << %s", str(self.ins), log_msg)
         try:
-            ret = self.ins.write_binary_values(message, values, datatype,
-                                               is_big_endian, termination,
-                                               encoding)
+            ret = self.ins.write_raw(b''.join([
+                (message + header).encode(encoding), payload,
+                termination.encode(encoding)]))
         except:
             log.exception("%s << %s", str(self.ins), log_msg)
             raise
@@ -416,10 +564,69 @@ class BaseDriver:
 
     def getValue(self, name, **kw):
         if name in self.quantities:
-            return self.performGetValue(self.quantities[name], **kw)
+            value = self.performGetValue(self.quantities[name], **kw)
+            self._check_cache(name, kw, value)
+            return value
         else:
             return None
 
+    def _check_cache(self, name, kw, value):
+        key = self._cache_key(name, kw)
+        if key in self._set_cache and not np.array_equal(self._set_cache[key], value):
+            # 仪器中的值已被改变
+            del self._set_cache[key]
+
+    def getValues(self, names, **kw):
+        """依次读取 names 中各量的值，kw 对所有量相同
+
+        能够合并的查询用分号连接为一条消息，回复按分号拆分后分别转换。仪器不支持
+        合并查询时改为逐个读取，并不再尝试合并。
+        """
+        values = [None] * len(names)
+        chain = []
+        for i, name in enumerate(names):
+            if self._chainable(name):
+                chain.append(i)
+            else:
+                values[i] = self.getValue(name, **kw)
+        while chain:
+            # 每条消息不超过 max_message_length
+            message, quants, n = '', [], 0
+            for i in chain:
+                quant = self.quantities[names[i]]
+                ch = quant.ch if kw.get('ch') is None else kw['ch']
+                cmd = quant._formatGetCmd(**dict(kw, ch=ch))
+                if quants and len(message) + len(cmd) + 2 > self.max_message_length:
+                    break
+                message = _join_command(message, cmd, self.command_separator) if quants else cmd
+                quants.append(quant)
+            done, chain = chain[:len(quants)], chain[len(quants):]
+            # I/O 错误（如超时）直接抛出，只有回复无法按查询拆分、转换时才不再合并
+            reply = self.query(message).strip().split(';')
+            try:
+                if len(reply) != len(quants):
+                    raise ValueError('%d replies for %d queries' % (len(reply), len(quants)))
+                res = [quant._parseReply(r) for quant, r in zip(quants, reply)]
+            except ValueError:
+                log.warning('%s can not chain queries, fall back to single queries.',
+                            str(self.ins))
+                self.chain_queries = False
+                res = [self.getValue(names[i], **kw) for i in done + chain]
+                done, chain = done + chain, []
+            for i, value in zip(done, res):
+                values[i] = value
+                self._check_cache(names[i], kw, value)
+        return values
+
+    def _chainable(self, name):
+        if (not self.chain_queries or self.command_separator is None
+                or self.ins is None or name not in self.quantities):
+            return False
+        quant = self.quantities[name]
+        return (quant.get_cmd != ''
+                and type(self).performGetValue is BaseDriver.performGetValue
+                and quant._parseReply is not None)
+
     def getIndex(self, name, **kw):
         if name in self.quantities:
             return self.quantities[name].getIndex(**kw)
@@ -428,11 +635,69 @@ class BaseDriver:
         if name in self.quantities:
             return self.quantities[name].getCmdOption(**kw)
 
-    def setValue(self, name, value, **kw):
+    def setValue(self, name, value, force=False, **kw):
+        """设置 name 的值
+
+        仪器中已是同样的值时不再发送命令，force 为 True 或 cache_set_values 为 False
+        时总是发送。
+        """
         if name in self.quantities:
+            key = self._cache_key(name, kw)
+            cached = key is not None and isinstance(value, (str, int, float, np.generic))
+            if (cached and not force and self.cache_set_values
+                    and key in self._set_cache and self._set_cache[key] == value):
+                return self
+            self._set_cache.pop(key, None)
             self.performSetValue(self.quantities[name], value, **kw)
+            if cached:
+                self._set_cache[key] = value
         return self
 
+    def _cache_key(self, name, kw):
+        """由量的名称与全部格式化参数（ch、channel、unit 等）组成缓存的键，
+        参数不可哈希时返回 None"""
+        ch = kw.get('ch')
+        kw = dict(kw, ch=self.quantities[name].ch if ch is None else ch)
+        key = (name, tuple(sorted(kw.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _run_in_executor(self, func, *args, **kw):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, functools.partial(func, *args, **kw))
+
+    async def aquery(self, message, **kw):
+        """query 的异步版本
+
+        同一驱动的异步调用在各自的线程中依次执行，不同仪器的调用可以并行：
+
+            await asyncio.gather(awg.asetValue('Vpp', 1, ch=1), lo.asetValue('Frequency', 6e9))
+
+        使用异步接口时不要在事件循环的线程中同时调用同一驱动的同步接口。
+        """
+        return await self._run_in_executor(self.query, message, **kw)
+
+    async def awrite(self, message, **kw):
+        """write 的异步版本"""
+        return await self._run_in_executor(self.write, message, **kw)
+
+    async def asetValue(self, name, value, **kw):
+        """setValue 的异步版本"""
+        return await self._run_in_executor(self.setValue, name, value, **kw)
+
+    async def agetValue(self, name, **kw):
+        """getValue 的异步版本"""
+        return await self._run_in_executor(self.getValue, name, **kw)
+
+    async def agetValues(self, names, **kw):
+        """getValues 的异步版本"""
+        return await self._run_in_executor(self.getValues, names, **kw)
+
     def performOpen(self, **kw):
         pass
 
@@ -447,20 +712,34 @@ class BaseDriver:
 
     def init(self, cfg={}):
         log.debug('Init instr ...')
-        for key in cfg.keys():
-            if isinstance(cfg[key], dict):
-                self.setValue(key, **cfg[key])
-            else:
-                self.setValue(key, cfg[key])
+        with self.batch():
+            for key in cfg.keys():
+                if isinstance(cfg[key], dict):
+                    self.setValue(key, **cfg[key])
+                else:
+                    self.setValue(key, cfg[key])
         log.debug('Init instr ... Done')
         return self
 
     def close(self):
         self.performClose()
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
         if self.ins is not None:
             self.ins.close()
 
 
+def _join_command(message, cmd, separator=';:'):
+    """用 separator 把 cmd 接在 message 之后
+
+    SCPI 的 ';:' 使命令从根节点开始，cmd 本身以 * 或 : 开头时只需要分号。
+    """
+    if separator == ';:' and cmd[:1] in '*:':
+        separator = ';'
+    return message + separator + cmd
+
+
 def _load_driver(driver_name):
     log.debug('Loading driver %s ...' % driver_name)
     mod = importlib.import_module(driver_name)
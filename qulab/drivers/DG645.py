@@ -9,6 +9,7 @@ from qulab import BaseDriver, QInteger, QOption, QReal, QString, QVector
 class Driver(BaseDriver):
     error_command = 'LERR?'
     support_models = ['DG645']
+    command_separator = None
 
     quants = [
         QReal('Trigger Rate', unit='Hz', set_cmd='TRAT %(value).6E', get_cmd='TRAT?'),
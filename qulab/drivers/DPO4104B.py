@@ -30,9 +30,9 @@ class Driver(BaseDriver):
         self.write(':DAT:START %d' % start)
         self.write(':DAT:STOP %d' % stop)
         y = np.array(self.query_ascii_values('CURV?'))
-        y_offset = self.getValue('Y Offset')
-        y_scale = self.getValue('Y Mult')
-        y_zero = self.getValue('Y Zero')
-        y = (y-y_offset)*y_scale+y_zero
-        x = np.arange(start-1, stop, 1)*self.getValue('X Step') + self.getValue('X Zero')
-        return x, (y*10-self.getValue('Y Position', ch=ch))*self.getValue('Y Scale', ch=ch)
+        y_offset, y_mult, y_zero, x_step, x_zero, y_position, y_scale = self.getValues(
+            ['Y Offset', 'Y Mult', 'Y Zero', 'X Step', 'X Zero', 'Y Position', 'Y Scale'],
+            ch=ch)
+        y = (y-y_offset)*y_mult+y_zero
+        x = np.arange(start-1, stop, 1)*x_step + x_zero
+        return x, (y*10-y_position)*y_scale
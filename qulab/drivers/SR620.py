@@ -10,6 +10,7 @@ from qulab import BaseDriver, QInteger, QOption, QReal, QString, QVector
 class Driver(BaseDriver):
     error_command = ''
     support_models = ['SR620']
+    command_separator = None
     quants = [
         QVector('Data', unit=''),
         QReal('Ext Level', unit='V', set_cmd='LEVL 0,%(value)f', get_cmd='LEVL? 0'),
@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
 import numpy as np
 
 from qulab import BaseDriver, QOption, QReal, QList
+from qulab.util import quantize
 
 
 class Driver(BaseDriver):
     support_models = ['AWG5014C', 'AWG5208']
 
+    # marker 所在的位：整数格式波形数据中的位置，以及 MARKER:DATA 中各型号的位置
+    int_marker_bits = [14, 15]
+    marker_bits = {'AWG5014C': [5, 6], 'AWG5208': [7, 6, 5, 4]}
+
+    # 增量上传时，间隔小于此点数的两段改动合并为一次写入
+    delta_min_gap = 256
+
     quants = [
         QReal('Sample Rate', unit='S/s',
           set_cmd='SOUR:FREQ %(value)f',
@@ -49,6 +59,15 @@ class Driver(BaseDriver):
     def performOpen(self):
         self.waveform_list = self.get_waveform_list()
         self.sequence_list = self.get_sequence_list()
+        self._reset_waveform_cache()
+
+    def _reset_waveform_cache(self):
+        # 波形名 -> 类型、长度；(波形名, 分量) -> 内容哈希、已上传的码值；内容哈希 -> (波形名, 分量)
+        self._waveform_types = {}
+        self._waveform_lengths = {}
+        self._waveform_hashes = {}
+        self._waveform_data = {}
+        self._waveform_index = {}
 
     def performSetValue(self, quant, value, **kw):
         if quant.name == '':
@@ -101,17 +120,50 @@ class Driver(BaseDriver):
                 format = 'INT'
         self.write('WLIS:WAV:NEW "%s",%d,%s;' % (name, length, format))
         self.waveform_list.append(name)
+        self._forget_waveform(name)
+        self._waveform_types[name] = format
+        self._waveform_lengths[name] = length
 
     def remove_waveform(self, name):
         if name not in self.waveform_list:
             return
         self.write(':WLIS:WAV:DEL "%s"; *CLS' % name)
         self.waveform_list.remove(name)
+        self._forget_waveform(name)
 
     def clear_waveform_list(self):
         wavs_to_delete = self.waveform_list.copy()
         for name in wavs_to_delete:
             self.remove_waveform(name)
+        self._reset_waveform_cache()
+
+    def _forget_waveform(self, name):
+        self._waveform_types.pop(name, None)
+        self._waveform_lengths.pop(name, None)
+        for key in [k for k in self._waveform_hashes if k[0] == name]:
+            self._record_waveform(key, None)
+
+    def _waveform_type(self, name):
+        if name not in self._waveform_types:
+            self._waveform_types[name] = self.query('WLISt:WAVeform:TYPE? "%s"' % name).strip()
+        return self._waveform_types[name]
+
+    def _waveform_length(self, name):
+        if name not in self._waveform_lengths:
+            self._waveform_lengths[name] = int(
+                self.query_ascii_values('WLIS:WAV:LENGTH? "%s"' % name, 'd')[0])
+        return self._waveform_lengths[name]
+
+    def find_waveform(self, points, format=None, IQ='I'):
+        """返回波形列表中内容与 points 相同的波形名，没有时返回 None
+
+        只能找到本次连接中由 update_waveform 完整上传过的波形。
+        """
+        if format is None:
+            format = 'REAL' if self.model in ['AWG5208'] else 'INT'
+        blocks = self._waveform_blocks(format, self._prepare_points(format, points), '', IQ, 0, None)
+        key = self._waveform_index.get(self._content_hash([b[1] for b in blocks]))
+        return None if key is None else key[0]
 
     def use_waveform(self, name, ch=1):
         self.write('SOURCE%d:WAVEFORM "%s"' % (ch, name))
@@ -142,53 +194,152 @@ class Driver(BaseDriver):
                 current_waveform_size = self.query_ascii_values('WLIS:WAV:LENGTH? "%s"' % wn, 'd')[0]
         return current_waveform_size, current_waveforms
 
-    def update_waveform(self, points, name='ABS', IQ='I', start=0, size=None):
-        w_type = self.query('WLISt:WAVeform:TYPE? "%s"' % name).strip()
-        if w_type == 'REAL':
-            self._update_waveform_float(points, name, IQ, start, size)
-        elif w_type == 'IQ':
-            self._update_waveform_float(points[0], name, 'I', start, size)
-            self._update_waveform_float(points[1], name, 'Q', start, size)
-        else:
-            self._update_waveform_int(points, name, start, size)
+    def update_waveform(self, points, name='ABS', IQ='I', start=0, size=None, markers=None):
+        """points 也可以是 Waveform（IQ 类型的波形为 (I, Q) 或 IQWaveform），此时按仪器当前的
+        采样率在本地生成，远程调用时只需传送波形的描述而非全部采样点
 
-    def _update_waveform_int(self, points, name='ABS', start=0, size=None):
+        markers: 与 points 等长的各 marker 数据 (mk1, mk2, ...)，整数格式的波形将 marker
+                 打包在波形数据中一起上传，其他格式另行调用 update_marker
+
+        仪器中的内容已知时（本次连接中完整上传过），只上传与其不同的部分。
         """
-        points : a 1D numpy.array which values between -1 and 1.
+        w_type = self._waveform_type(name)
+        if markers is not None and w_type != 'INT':
+            self.update_marker(name, *markers, start=start, size=size)
+            markers = None
+        points = self._prepare_points(w_type, points)
+        blocks = self._waveform_blocks(w_type, points, name, IQ, start, size, markers)
+        key = self._waveform_key(w_type, name, IQ)
+        values = [b[1] for b in blocks]
+        length = len(values[0])
+        data = self._waveform_data.get(key)
+        if data is None or start + length > len(data[0]):
+            self._write_blocks(blocks)
+            if start == 0 and length == self._waveform_length(name):
+                self._record_waveform(key, values)
+            else:
+                self._record_waveform(key, None)
+            return
+        old = [v[start:start+length] for v in data]
+        components = {'REAL': [IQ], 'IQ': ['I', 'Q']}.get(w_type, [None])
+        for lo, hi in self._changed_ranges(old, values, self.delta_min_gap):
+            self._write_blocks([
+                (self._data_message(name, c, start+lo, hi-lo), v[lo:hi], datatype)
+                for c, (message, v, datatype) in zip(components, blocks)])
+        for v, n in zip(old, values):
+            v[:] = n
+        self._record_waveform(key, data)
+
+    def _waveform_key(self, w_type, name, IQ):
+        return (name, IQ if w_type == 'REAL' and self.model == 'AWG5208' else None)
+
+    def _record_waveform(self, key, data):
+        """记录仪器中波形的内容，data 为各分量的码值，None 表示内容未知"""
+        old = self._waveform_hashes.pop(key, None)
+        self._waveform_data.pop(key, None)
+        if old is not None and self._waveform_index.get(old) == key:
+            del self._waveform_index[old]
+        if data is not None:
+            content = self._content_hash(data)
+            self._waveform_data[key] = data
+            self._waveform_hashes[key] = content
+            self._waveform_index[content] = key
+
+    @staticmethod
+    def _content_hash(data):
+        h = hashlib.sha1()
+        for values in data:
+            h.update(values.dtype.str.encode())
+            h.update(np.ascontiguousarray(values).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def _changed_ranges(old, new, min_gap=0):
+        """比较各分量的新旧码值，返回有改动的区间 [(lo, hi), ...]
+
+        相邻两段改动之间不变的点数小于 min_gap 时合并为一段，以减少写入次数。
         """
-        message = 'WLIST:WAVEFORM:DATA "%s",%d,' % (name, start)
-        if size is not None:
-            message = message + ('%d,' % size)
-        points = points.clip(-1,1)
-        values = (points * 0x1fff).astype(int) + 0x1fff
-        self.write_binary_values(message, values, datatype=u'H',
-                                 is_big_endian=False,
-                                 termination=None, encoding=None)
-
-    def _update_waveform_float(self, points, name='ABS', IQ='I', start=0, size=None):
-        if self.model == 'AWG5208':
+        changed = np.zeros(len(new[0]), dtype=bool)
+        for a, b in zip(old, new):
+            changed |= a != b
+        index = np.flatnonzero(changed)
+        if len(index) == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(index) > min_gap)
+        lo = np.r_[index[0], index[breaks+1]]
+        hi = np.r_[index[breaks], index[-1]] + 1
+        return list(zip(lo.tolist(), hi.tolist()))
+
+    def _prepare_points(self, w_type, points):
+        if w_type == 'IQ' and hasattr(points, 'generateData'):
+            # IQWaveform 一次生成两路数据
+            return points.generateData(self.getValue('Sample Rate'))
+        return points
+
+    def _quantize(self, points, dtype, markers=None, **kw):
+        """将波形数据转换为码值，Waveform 按仪器当前的采样率直接生成码值"""
+        if hasattr(points, 'generateSamples'):
+            return points.generateSamples(self.getValue('Sample Rate'), dtype,
+                                          markers=markers or {}, **kw)
+        return quantize(points, dtype, markers=markers or {}, **kw)
+
+    def _data_message(self, name, IQ, start, size):
+        if IQ is not None and self.model == 'AWG5208':
             message = 'WLIST:WAVEFORM:DATA:%s "%s",%d,' % (IQ, name, start)
         else:
             message = 'WLIST:WAVEFORM:DATA "%s",%d,' % (name, start)
         if size is not None:
             message = message + ('%d,' % size)
-        values = points.clip(-1,1)
-        self.write_binary_values(message, values, datatype=u'f',
-                                 is_big_endian=False,
-                                 termination=None, encoding=None)
+        return message
+
+    def stream_waveform(self, chunks, name='ABS', IQ='I', start=0):
+        """逐段上传波形数据，内存占用只取决于每段的长度
+
+        chunks: 依次给出各段数据的可迭代对象，如 Waveform.generateData(..., chunk=2**16)，
+                IQ 类型的波形每段为 (I, Q)
+        """
+        w_type = self._waveform_type(name)
+        self._record_waveform(self._waveform_key(w_type, name, IQ), None)
+        for points in chunks:
+            size = len(points[0]) if w_type == 'IQ' else len(points)
+            self._write_blocks(self._waveform_blocks(w_type, points, name, IQ, start, size))
+            start += size
+
+    def _waveform_blocks(self, w_type, points, name, IQ, start, size, markers=None):
+        """返回需要上传的数据 [(message, values, datatype), ...]"""
+        if w_type == 'REAL':
+            return [self._waveform_float_block(points, name, IQ, start, size)]
+        elif w_type == 'IQ':
+            return [self._waveform_float_block(points[0], name, 'I', start, size),
+                    self._waveform_float_block(points[1], name, 'Q', start, size)]
+        else:
+            return [self._waveform_int_block(points, name, start, size, markers)]
+
+    def _write_blocks(self, blocks):
+        for message, values, datatype in blocks:
+            self.write_binary_values(message, values, datatype=datatype,
+                                     is_big_endian=False,
+                                     termination=None, encoding=None)
+
+    def _waveform_int_block(self, points, name='ABS', start=0, size=None, markers=None):
+        """
+        points : a 1D numpy.array which values between -1 and 1, or a Waveform.
+        markers: marker 数据，打包在 14 位码值之上
+        """
+        message = self._data_message(name, None, start, size)
+        values = self._quantize(points, 'uint16', scale=0x1fff, offset=0x1fff,
+                                clip=(-0x1fff, 0x1fff),
+                                markers=self._marker_map(markers, self.int_marker_bits))
+        return message, values, u'H'
+
+    def _waveform_float_block(self, points, name='ABS', IQ='I', start=0, size=None):
+        message = self._data_message(name, IQ, start, size)
+        values = self._quantize(points, 'float32', clip=(-1, 1))
+        return message, values, u'f'
 
     def update_marker(self, name, mk1, mk2=None, mk3=None, mk4=None, start=0, size=None):
-        def format_marker_data(markers, bits):
-            values = 0
-            for i, v in markers:
-                v = 0 if v is None else np.asarray(v)
-                values += v << bits[i]
-            return values
-
-        if self.model in ['AWG5014C']:
-            values = format_marker_data([mk1, mk2], [5,6])
-        elif self.model in ['AWG5208']:
-            values = format_marker_data([mk1, mk2, mk3, mk4], [7,6,5,4])
+        markers = self._marker_map([mk1, mk2, mk3, mk4], self.marker_bits[self.model])
+        values = quantize(np.zeros(len(np.asarray(mk1))), 'uint8', markers=markers)
         if size is None:
             message = 'WLIST:WAVEFORM:MARKER:DATA "%s",%d,' % (name, start)
         else:
@@ -197,6 +348,13 @@ class Driver(BaseDriver):
                                  is_big_endian=False,
                                  termination=None, encoding=None)
 
+    @staticmethod
+    def _marker_map(markers, bits):
+        """将 marker 列表转换为 quantize 所需的 {bit: marker}，略去为 None 的 marker"""
+        if markers is None:
+            return {}
+        return {bit: mk for bit, mk in zip(bits, markers) if mk is not None}
+
     def create_sequence(self, name, steps, tracks):
         if name in self.sequence_list:
             return
@@ -225,17 +383,78 @@ class Driver(BaseDriver):
             jump_input: ATRigger | BTRigger | OFF | ITRigger
             jump_to: <NR1> | NEXT | FIRSt | LAST | END
         """
+        for cmd in self._sequence_step_commands(name, sub_name, step, wait, goto, repeat, jump):
+            self.write(cmd)
+
+    def _sequence_step_commands(self, name, sub_name, step, wait='OFF', goto='NEXT', repeat=1, jump=None):
+        cmds = []
         if isinstance(sub_name, str):
-            self.write('SLIS:SEQ:STEP%d:TASS:SEQ "%s","%s"' % (step, name, sub_name))
+            cmds.append('SLIS:SEQ:STEP%d:TASS:SEQ "%s","%s"' % (step, name, sub_name))
         else:
             for i, wav in enumerate(sub_name):
-                self.write('SLIS:SEQ:STEP%d:TASS%d:WAV "%s","%s"' % (step, i+1, name, wav))
-        self.write('SLIS:SEQ:STEP%d:WINP "%s", %s' % (step, name, wait))
-        self.write('SLIS:SEQ:STEP%d:GOTO "%s", %s' % (step, name, goto))
-        self.write('SLIS:SEQ:STEP%d:RCO "%s", %s' % (step, name, repeat))
+                cmds.append('SLIS:SEQ:STEP%d:TASS%d:WAV "%s","%s"' % (step, i+1, name, wav))
+        cmds.append('SLIS:SEQ:STEP%d:WINP "%s", %s' % (step, name, wait))
+        cmds.append('SLIS:SEQ:STEP%d:GOTO "%s", %s' % (step, name, goto))
+        cmds.append('SLIS:SEQ:STEP%d:RCO "%s", %s' % (step, name, repeat))
         if jump is not None:
-            self.write('SLIS:SEQ:STEP%d:EJIN "%s", %s' % (step, name, jump[0]))
-            self.write('SLIS:SEQ:STEP%d:EJUM "%s", %s' % (step, name, jump[1]))
+            cmds.append('SLIS:SEQ:STEP%d:EJIN "%s", %s' % (step, name, jump[0]))
+            cmds.append('SLIS:SEQ:STEP%d:EJUM "%s", %s' % (step, name, jump[1]))
+        return cmds
+
+    def program_sequence(self, name, steps, tracks=None):
+        """新建序列 name 并一次写入所有步，已有的同名序列将被删除
+
+        steps: 各步的设置，每步为 set_sequence_step 的参数组成的 dict
+               （sub_name, wait, goto, repeat, jump），或只给出 sub_name
+        tracks: 轨道数，默认由第一个给出波形列表的步推断
+
+        各步的命令用分号连接成不超过 max_message_length 的批次发送，只在批次之间
+        用 *OPC? 等待仪器处理完毕并检查错误。返回 {step: [(code, msg), ...]}，
+        只包含出错的步。新建序列时的错误记在步 0 下，此时不再写入各步；批次中
+        逐步重发后不再出现的错误记在 (first, last) 下，为该批次的首末步。
+        """
+        steps = [s if isinstance(s, dict) else {'sub_name': s} for s in steps]
+        if tracks is None:
+            tracks = next((len(s['sub_name']) for s in steps
+                           if not isinstance(s['sub_name'], str)), 1)
+        self.remove_sequence(name)
+        self.create_sequence(name, len(steps), tracks)
+        self.query('*OPC?')
+        e = self.errors()
+        if e:
+            return {0: e}
+
+        errors = {}
+        batch, length = [], 0
+        for step, kw in enumerate(steps, start=1):
+            cmds = self._sequence_step_commands(name, step=step, **kw)
+            size = sum(len(cmd) + 2 for cmd in cmds)
+            if batch and length + size > self.max_message_length:
+                errors.update(self._write_sequence_batch(batch))
+                batch, length = [], 0
+            batch.append((step, cmds))
+            length += size
+        if batch:
+            errors.update(self._write_sequence_batch(batch))
+        return errors
+
+    def _write_sequence_batch(self, batch):
+        self.write(';:'.join(cmd for step, cmds in batch for cmd in cmds))
+        self.query('*OPC?')
+        batch_errors = self.errors()
+        if not batch_errors:
+            return {}
+        # 批次中有错误时逐步重发，以确定出错的步
+        errors = {}
+        for step, cmds in batch:
+            for cmd in cmds:
+                self.write(cmd)
+            e = self.errors()
+            if e:
+                errors[step] = e
+        if not errors:
+            errors[(batch[0][0], batch[-1][0])] = batch_errors
+        return errors
 
     def use_sequence(self, name, channels=[1,2]):
         for i, ch in enumerate(channels):
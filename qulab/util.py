@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import struct
-
 import numpy as np
 from scipy.special import sici
 from scipy.stats import beta
@@ -155,6 +153,112 @@ def Std_of_norm_from_FWHM(FWHM):
     return FWHM / (2 * np.sqrt(2 * np.log(2)))
 
 
+def quantize(data, dtype='int16', scale=1.0, offset=0, clip=None, markers={}, out=None, copy=True):
+    """将浮点数据转换为 DAC 码值，一次完成缩放、截断、平移和打包 marker
+
+    data   : 浮点数据
+    dtype  : 目标数据类型，如 int16, uint16, float32
+    scale  : 缩放系数
+    offset : 缩放、截断之后加上的偏置
+    clip   : (low, high)，对缩放后的数据截断
+    markers: {bit: marker}，marker 不为 0 的点在码值中将第 bit 位置 1
+    out    : 存放结果的数组，不给出时新建
+    copy   : 为 False 时直接在 data 上计算，节省一次内存分配
+
+    整数类型向零取整，与 astype(int) 一致。
+    """
+    dtype = np.dtype(dtype) if out is None else out.dtype
+    y = np.asarray(data, dtype=float)
+    y = np.multiply(y, scale, out=None if copy else y)
+    if clip is not None:
+        np.clip(y, clip[0], clip[1], out=y)
+    if dtype.kind in 'iu':
+        np.trunc(y, out=y)
+    if offset != 0:
+        y += offset
+    if out is None:
+        out = np.empty(y.shape, dtype=dtype)
+    np.copyto(out, y, casting='unsafe')
+    for bit, marker in markers.items():
+        mask = np.not_equal(marker, 0).astype(dtype)
+        np.left_shift(mask, bit, out=mask)
+        np.bitwise_or(out, mask, out=out)
+    return out
+
+
+_binary_types = {
+    "b"      : 'b', "B"      : 'B',
+    "h"      : 'h', "H"      : 'H',
+    "i"      : 'i', "I"      : 'I',
+    "q"      : 'q', "Q"      : 'Q',
+    "f"      : 'f', "d"      : 'd',
+    "int8"   : 'b', "uint8"  : 'B',
+    "int16"  : 'h', "uint16" : 'H',
+    "int32"  : 'i', "uint32" : 'I',
+    "int64"  : 'q', "uint64" : 'Q',
+    "float"  : 'f', "double" : 'd',
+    "float32": 'f', "float64": 'd'}
+
+
+def _binary_dtype(dtype, is_big_endian):
+    dtype = np.dtype(_binary_types.get(dtype, dtype))
+    return dtype.newbyteorder('>' if is_big_endian else '<')
+
+
+def IEEE_488_2_encode(values, dtype="int16", is_big_endian=True):
+    """将数组编码为 IEEE 488.2 标准二进制块
+
+    values : 要打包的数组
+    dtype  : 数据类型，struct 格式字符、类型名或 numpy 的 dtype
+    endian : 字节序
+
+    返回 (header, payload)，header 为 '#<n><length>' 字符串，payload 为数据的
+    memoryview。values 已是连续且类型、字节序相符的数组时不复制数据。
+    """
+    a = np.ascontiguousarray(values, dtype=_binary_dtype(dtype, is_big_endian))
+    payload = memoryview(a.reshape(-1).view(np.uint8))
+    size = '%d' % payload.nbytes
+    header = '#%d%s' % (len(size), size)
+    return header, payload
+
+
+def IEEE_488_2_decode(block, dtype="int16", is_big_endian=True):
+    """将 IEEE 488.2 标准二进制块解码为数组
+
+    block  : 收到的数据，可以包含二进制块之前的内容及其后的结束符
+    dtype  : 数据类型
+    endian : 字节序
+
+    返回的数组直接引用 block 的内存，不复制数据。
+    """
+    block = memoryview(block).cast('B')
+    offset = bytes(block[:64]).find(b'#')
+    if offset < 0:
+        raise ValueError('Could not find the header of binary block.')
+    n = int(bytes(block[offset+1:offset+2]))
+    if n == 0:
+        # 不定长的块以结束符 LF 结尾
+        start = offset + 2
+        size = len(block) - start - (bytes(block[-1:]) == b'\n')
+    else:
+        start = offset + 2 + n
+        size = int(bytes(block[offset+2:start]))
+    dtype = _binary_dtype(dtype, is_big_endian)
+    return np.frombuffer(block, dtype=dtype, count=size // dtype.itemsize, offset=start)
+
+
+def IEEE_488_2_block_size(block):
+    """返回 block 中二进制块的完整长度（不含结束符），头部尚不完整时返回 None"""
+    block = bytes(block[:64])
+    offset = block.find(b'#')
+    if offset < 0 or len(block) < offset + 2:
+        return None
+    n = int(block[offset+1:offset+2])
+    if n == 0 or len(block) < offset + 2 + n:
+        return None
+    return offset + 2 + n + int(block[offset+2:offset+2+n])
+
+
 def IEEE_488_2_BinBlock(datalist, dtype="int16", is_big_endian=True):
     """将一组数据打包成 IEEE 488.2 标准二进制块
 
@@ -164,29 +268,8 @@ def IEEE_488_2_BinBlock(datalist, dtype="int16", is_big_endian=True):
 
     返回二进制块, 以及其 'header'
     """
-    types = {"b"      : (  int, 'b'), "B"      : (  int, 'B'),
-             "h"      : (  int, 'h'), "H"      : (  int, 'H'),
-             "i"      : (  int, 'i'), "I"      : (  int, 'I'),
-             "q"      : (  int, 'q'), "Q"      : (  int, 'Q'),
-             "f"      : (float, 'f'), "d"      : (float, 'd'),
-             "int8"   : (  int, 'b'), "uint8"  : (  int, 'B'),
-             "int16"  : (  int, 'h'), "uint16" : (  int, 'H'),
-             "int32"  : (  int, 'i'), "uint32" : (  int, 'I'),
-             "int64"  : (  int, 'q'), "uint64" : (  int, 'Q'),
-             "float"  : (float, 'f'), "double" : (float, 'd'),
-             "float32": (float, 'f'), "float64": (float, 'd')}
-
-    datalist = np.asarray(datalist)
-    datalist.astype(types[dtype][0])
-    if is_big_endian:
-        endianc = '>'
-    else:
-        endianc = '<'
-    datablock = struct.pack('%s%d%s' % (endianc, len(datalist), types[dtype][1]), *datalist)
-    size = '%d' % len(datablock)
-    header = '#%d%s' % (len(size),size)
-
-    return header.encode()+datablock, header
+    header, payload = IEEE_488_2_encode(datalist, dtype, is_big_endian)
+    return header.encode() + payload, header
 
 
 if __name__ == '__main__':
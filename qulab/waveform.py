@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
-import copy
+import bisect
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
+
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, signal
 from scipy.special import erf, sinc
 import matplotlib.pyplot as plt
 
+from .util import quantize
+
 def _comb_domain(a_domain, b_domain):
     start = min(a_domain[0], b_domain[0])
     stop = max(a_domain[1], b_domain[1])
@@ -18,6 +26,515 @@ def _comb_outside(a_domain, b_domain, a_outside, b_outside):
     b = a_outside[1] if a_domain[1] >= b_domain[1] else b_outside[1]
     return (a, b)
 
+# 计算窗口: ((t0, side0), (t1, side1))，与 np.searchsorted 的 side 参数对应
+#   下界 (t, 'left') 表示 x >= t, (t, 'right') 表示 x > t
+#   上界 (t, 'left') 表示 x <  t, (t, 'right') 表示 x <= t
+_ALL = ((-np.inf, 'left'), (np.inf, 'right'))
+
+def _bound_key(bound):
+    return (bound[0], bound[1] == 'right')
+
+def _intersect(window, lower=None, upper=None):
+    lo, hi = window
+    if lower is not None and _bound_key(lower) > _bound_key(lo):
+        lo = lower
+    if upper is not None and _bound_key(upper) < _bound_key(hi):
+        hi = upper
+    return lo, hi
+
+def _is_empty(window):
+    return window[0][0] > window[1][0]
+
+def _window_index(x, window):
+    (t0, s0), (t1, s1) = window
+    lo = 0 if t0 == -np.inf else int(np.searchsorted(x, t0, s0))
+    hi = len(x) if t1 == np.inf else int(np.searchsorted(x, t1, s1))
+    return lo, max(lo, hi)
+
+class _Grid():
+    '''采样网格 np.arange(start, stop, step) - shift
+
+    可以分段计算网格中的任意一段，结果与 np.arange 一次性生成的逐位一致。
+    '''
+    def __init__(self, start, stop, step, shift=0):
+        self.start = start
+        self.step = step
+        self.delta = (start + step) - start
+        self.size = max(int(np.ceil((stop - start) / step)), 0)
+        self.shift = shift
+
+    def shifted(self, shift):
+        grid = _Grid.__new__(_Grid)
+        grid.__dict__.update(self.__dict__)
+        grid.shift = self.shift + shift
+        return grid
+
+    def x(self, i0, i1):
+        # 与 numpy 中 arange 的填充方式相同：第二个点为 start+step，其余为 start+i*delta
+        x = self.start + np.arange(i0, i1) * self.delta
+        if i0 <= 1 < i1:
+            x[1-i0] = self.start + self.step
+        if self.shift != 0:
+            x -= self.shift
+        return x
+
+    def index(self, t, side='left'):
+        '''相当于在整个网格上调用 np.searchsorted'''
+        i = int(np.clip(np.floor((t + self.shift - self.start) / self.delta) - 2, 0, self.size))
+        j = min(i + 6, self.size)
+        return i + int(np.searchsorted(self.x(i, j), t, side))
+
+def _tile(out, base, phase):
+    '''从 base 的第 phase 个点开始，将 base 循环填入 out 的最后一维'''
+    n, size = out.shape[-1], base.shape[-1]
+    k = min(size - phase, n)
+    out[..., :k] = base[..., phase:phase+k]
+    rest = out[..., k:]
+    m = rest.shape[-1] // size
+    step = rest.strides[-1]
+    tiles = np.lib.stride_tricks.as_strided(rest,
+        shape=rest.shape[:-1]+(m, size), strides=rest.strides[:-1]+(size*step, step))
+    tiles[...] = base[..., None, :]
+    rest[..., m*size:] = base[..., :rest.shape[-1]-m*size]
+
+# 分段常数表示: (keys, values)
+#   keys 为升序排列的分界点，values 比 keys 多一项，values[i] 为第 i-1 与第 i 个分界点之间的取值。
+#   分界点由 locate(t, side, shift) 给出：采样点 x 满足 x - shift < t (side='left') 或
+#   x - shift <= t (side='right') 时在分界点之前。对采样点数组，分界点为采样点的序号，
+#   比较方式与逐点计算时相同，因而结果逐位一致。
+def _array_locate(x):
+    def locate(t, side, shift):
+        i = int(np.searchsorted(x, t+shift, side))
+        if shift == 0:
+            return i
+        return _adjust_index(lambda j: x[j], len(x), i, t, side, shift)
+    return locate
+
+def _grid_locate(grid):
+    def locate(t, side, shift):
+        i = grid.index(t+shift, side)
+        if shift == 0:
+            return i
+        return _adjust_index(lambda j: grid.x(j, j+1)[0], grid.size, i, t, side, shift)
+    return locate
+
+def _time_locate(t, side, shift):
+    return _bound_key((t+shift, side))
+
+def _adjust_index(at, n, i, t, side, shift):
+    if side == 'left':
+        before = lambda j: at(j) - shift < t
+    else:
+        before = lambda j: at(j) - shift <= t
+    while i > 0 and not before(i-1):
+        i -= 1
+    while i < n and before(i):
+        i += 1
+    return i
+
+def _pieces_simplify(keys, values):
+    '''去掉两侧取值相同的分界点'''
+    k, v = [], [values[0]]
+    for key, value in zip(keys, values[1:]):
+        if value != v[-1]:
+            k.append(key)
+            v.append(value)
+    return k, v
+
+def _pieces_stitch(regions):
+    '''依次拼接各区间上的分段常数，regions 为 [((keys, values), 上界), ...]，最后一个的上界为 None'''
+    keys, values = [], []
+    lower = None
+    for (k, v), upper in regions:
+        if lower is not None and upper is not None and upper <= lower:
+            continue
+        i = 0 if lower is None else bisect.bisect_right(k, lower)
+        j = len(k) if upper is None else bisect.bisect_left(k, upper)
+        if lower is not None:
+            keys.append(lower)
+        values.append(v[i])
+        keys.extend(k[i:j])
+        values.extend(v[i+1:j+1])
+        lower = upper
+    return _pieces_simplify(keys, values)
+
+def _pieces_combine(ufunc, operands):
+    '''对各分段常数（或标量）逐段作用 ufunc'''
+    keys = sorted({key for o in operands if isinstance(o, tuple) for key in o[0]})
+    args = []
+    for o in operands:
+        if isinstance(o, tuple):
+            k, v = o
+            args.append(np.array([v[0]] + [v[bisect.bisect_right(k, key)] for key in keys]))
+        else:
+            args.append(o)
+    with np.errstate(all='ignore'):
+        values = reduce(ufunc, args) if len(args) > 1 else ufunc(args[0])
+    return _pieces_simplify(keys, list(np.broadcast_to(values, (len(keys)+1,))))
+
+def _postorder(wav, visit):
+    '''使用显式栈自下而上遍历表达式树，共用的子树只访问一次
+
+    visit(node, structure, children) 的返回值为该节点的结果，其中 structure 为
+    node._structure()，children 为各子节点的结果。返回 {id(node): 结果}。
+    '''
+    table = {}
+    stack = [wav]
+    while stack:
+        node = stack[-1]
+        if id(node) in table:
+            stack.pop()
+            continue
+        structure = node._structure()
+        children = [] if structure is None else structure[1]
+        pending = [c for c in children if id(c) not in table]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        table[id(node)] = visit(node, structure, [table[id(c)] for c in children])
+    return table
+
+def _piecewise_table(wav):
+    '''表达式树中各节点是否为分段常数'''
+    return _postorder(wav, lambda node, structure, children: node._piecewise(children))
+
+def _register_table(wav):
+    '''表达式树中各节点展开时所需的寄存器数目（Sethi–Ullman 数）'''
+    return _postorder(wav, lambda node, structure, children: node._registers(children))
+
+def _bounds_table(wav):
+    '''表达式树中各节点取值不为常数的范围 (start, stop, left, right)，见 Waveform._bounds'''
+    return _postorder(wav, lambda node, structure, children: node._bounds(children))
+
+def _pieces(wav, shift, locate):
+    '''自上而下计算分段常数波形 wav(x - shift) 的分段，各节点的平移量与逐点计算时的相同'''
+    results = []
+    stack = [(wav, shift, False)]
+    while stack:
+        node, shift, expanded = stack.pop()
+        if expanded:
+            children = node._pieces_children(shift)
+            args = results[len(results)-len(children):]
+            del results[len(results)-len(children):]
+            results.append(node._pieces(shift, args, locate))
+            continue
+        stack.append((node, shift, True))
+        for child in reversed(node._pieces_children(shift)):
+            stack.append(child + (False,))
+    return results[0]
+
+def _render_pieces(x, out, node, shift):
+    keys, values = _pieces(node, shift, _array_locate(x))
+    if len(values) > 32:
+        out[...] = np.repeat(values, np.diff([0] + keys + [len(x)]))
+        return
+    for start, stop, value in zip([0] + keys, keys + [len(x)], values):
+        out[..., start:stop] = value
+
+# 计算计划中的指令
+_LEAF, _UNARY, _SCALAR, _BINARY, _REPEAT, _PIECES, _FILL = range(7)
+
+class _Plan():
+    '''展开后的波形计算计划
+
+    ops  : 指令列表，每条指令为 (code, window, dst, *args)
+    nregs: 所需寄存器（缓冲区）数目，0 号寄存器存放结果
+    '''
+    def __init__(self, ops, nregs):
+        self.ops = ops
+        self.nregs = nregs
+
+    def execute(self, x, out=None, grid=None, offset=0, batch=()):
+        '''在升序排列的采样点 x 上执行计划
+
+        grid  : 若 x 为采样网格 grid 中从第 offset 个点开始的一段，给出 grid，
+                可启用重复波形的平铺加速，并保证分段计算与一次性计算的结果一致
+        batch : 批量计算时参数轴的形状，结果的形状为 batch + (len(x),)
+        '''
+        shape = tuple(batch) + (len(x),) if out is None else out.shape
+        bufs = [None] * self.nregs
+        bufs[0] = np.zeros(shape) if out is None else out
+        for code, window, dst, *args in self.ops:
+            lo, hi = _window_index(x, window)
+            if lo >= hi:
+                continue
+            if bufs[dst] is None:
+                bufs[dst] = np.empty(shape)
+            buff = bufs[dst][..., lo:hi]
+            if code == _LEAF:
+                leaf, shift = args
+                leaf._render(x[lo:hi], buff, shift)
+            elif code == _UNARY:
+                ufunc, = args
+                ufunc(buff, out=buff)
+            elif code == _SCALAR:
+                ufunc, v, reverse = args
+                if reverse:
+                    ufunc(v, buff, out=buff)
+                else:
+                    ufunc(buff, v, out=buff)
+            elif code == _BINARY:
+                ufunc, src, reverse = args
+                if reverse:
+                    ufunc(bufs[src][..., lo:hi], buff, out=buff)
+                else:
+                    ufunc(buff, bufs[src][..., lo:hi], out=buff)
+            elif code == _REPEAT:
+                node, plan, shift = args
+                node._render_repeat(plan, x[lo:hi], buff, shift, grid, offset+lo)
+            elif code == _PIECES:
+                node, shift = args
+                _render_pieces(x[lo:hi], buff, node, shift)
+            elif code == _FILL:
+                v, = args
+                buff[...] = v
+        return bufs[0]
+
+class _Compiler():
+    '''将波形表达式树展开为 _Plan
+
+    使用显式栈遍历表达式树，避免长序列触及递归深度限制。
+    '''
+    def __init__(self, values=None):
+        self.ops = []
+        self.nregs = 1
+        self._free = []
+        self._stack = []
+        self.values = {} if values is None else values
+        self.registers = {}
+        self.bounds = {}
+
+    def value(self, v):
+        '''将 Param 替换为其取值，批量计算时为形如 (n, 1) 的数组'''
+        if isinstance(v, Param):
+            return self.values.get(v.name, float(v))
+        return v
+
+    def bind(self, leaf):
+        if self.values and leaf._params():
+            return leaf._bind(self.value)
+        return leaf
+
+    def alloc(self):
+        if self._free:
+            return self._free.pop()
+        self.nregs += 1
+        return self.nregs - 1
+
+    def release(self, reg):
+        self._free.append(reg)
+
+    def emit(self, code, window, dst, *args):
+        self.ops.append((code, window, dst) + args)
+
+    def push(self, node, shift, window, dst):
+        if not _is_empty(window):
+            self._stack.append((node, shift, window, dst))
+
+    def defer(self, func):
+        self._stack.append(func)
+
+    def narrow(self, node, shift, window):
+        '''返回 (inner, fills)
+
+        inner 为 window 中 node(x - shift) 取值不为常数的部分，fills 为其两侧的 [(窗口, 常数), ...]。
+        边界稍稍放宽，多算几个采样点不影响结果。
+        '''
+        bounds = self.bounds.get(id(node)) if np.ndim(shift) == 0 else None
+        if bounds is None:
+            return window, []
+        start, stop, left, right = bounds
+        margin = 1e-9 * (abs(start) + abs(stop) + abs(shift))
+        lower, upper = (start+shift-margin, 'left'), (stop+shift+margin, 'right')
+        fills = []
+        if _bound_key(window[0]) < _bound_key(lower):
+            fills.append((_intersect(window, upper=lower), left))
+        if _bound_key(upper) < _bound_key(window[1]):
+            fills.append((_intersect(window, lower=upper), right))
+        return _intersect(window, lower, upper), fills
+
+    def sparse(self, node, shift, window):
+        '''node(x - shift) 在某一范围之外恒为零时，返回 window 中该范围的部分，否则返回 None'''
+        bounds = self.bounds.get(id(node)) if np.ndim(shift) == 0 else None
+        if bounds is None or bounds[2] != 0 or bounds[3] != 0:
+            return None
+        return self.narrow(node, shift, window)[0]
+
+    def compile(self, wav):
+        # 分段常数的子树按分界点直接填充；批量计算时参数会改变分界点，不使用
+        piecewise = {} if self.values else _piecewise_table(wav)
+        # 在某一范围之外取值为常数的子树只在该范围内逐点计算，其余部分直接填充
+        self.bounds = {} if self.values else _bounds_table(wav)
+        self.registers = _register_table(wav)
+        self.push(wav, 0, _ALL, 0)
+        while self._stack:
+            task = self._stack.pop()
+            if callable(task):
+                task()
+                continue
+            node, shift, window, dst = task
+            if piecewise.get(id(node)) and np.ndim(shift) == 0:
+                self.emit(_PIECES, window, dst, node, shift)
+                continue
+            window, fills = self.narrow(node, shift, window)
+            for w, v in fills:
+                self.emit(_FILL, w, dst, v)
+            node._emit(self, shift, window, dst)
+        return _Plan(self.ops, self.nregs)
+
+def _check_scalar_shift(shift):
+    if np.ndim(shift) != 0:
+        raise ValueError('parametric shift can not be applied to Concat, Repeat or Overwrite')
+
+class Param(float):
+    '''波形模板中的自由参数
+
+    可作为运算中的标量、平移量以及 Gaussian, Step, DC, Sin, Cos, Sinc 的参数使用。
+    单独使用时等同于默认值 default，在 Waveform.generateBatch 中替换为给定的一组取值。
+    参数只改变波形的取值，拼接、重复和覆盖的边界由默认值确定。
+    '''
+    def __new__(cls, name, default=0.0):
+        p = super(Param, cls).__new__(cls, default)
+        p.name = name
+        return p
+
+    def __repr__(self):
+        return 'Param(%r, %r)' % (self.name, float(self))
+
+    def __reduce__(self):
+        return (Param, (self.name, float(self)))
+
+def _update_digest(h, v):
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, np.ndarray):
+        h.update(('%s%r' % (v.dtype.str, v.shape)).encode())
+        h.update(np.ascontiguousarray(v).tobytes())
+    elif isinstance(v, (tuple, list)):
+        h.update(b'(')
+        for item in v:
+            _update_digest(h, item)
+            h.update(b',')
+        h.update(b')')
+    else:
+        h.update(repr(v).encode())
+
+def _spec_encode(v):
+    '''将 spec 中的参数转换为 json 可编码的类型'''
+    if isinstance(v, Param):
+        return {'param': v.name, 'default': float(v)}
+    elif isinstance(v, np.ndarray):
+        return {'array': v.tolist(), 'dtype': v.dtype.str}
+    elif isinstance(v, (tuple, list)):
+        return [_spec_encode(item) for item in v]
+    elif isinstance(v, np.generic):
+        return v.item()
+    else:
+        return v
+
+def _spec_decode(v):
+    '''_spec_encode 的逆变换，其余类型原样返回'''
+    if isinstance(v, dict):
+        if 'param' in v:
+            return Param(v['param'], v['default'])
+        return np.asarray(v['array'], dtype=v['dtype'])
+    elif isinstance(v, list):
+        return [_spec_decode(item) for item in v]
+    else:
+        return v
+
+def _structural_hash(wav):
+    '''计算表达式树中各节点的结构哈希，不可哈希的节点记为 None
+
+    各节点保存 (哈希, 子节点的哈希)，子节点的哈希不变时直接使用，子树被
+    set_range 等修改后父节点的哈希随之更新。
+    '''
+    def visit(node, structure, child_hashes):
+        if structure is None or None in child_hashes:
+            return None
+        cached = node._hash_cache
+        if cached is not _UNSET and cached[1] == child_hashes:
+            return cached[0]
+        h = hashlib.sha1(type(node).__name__.encode())
+        _update_digest(h, (structure[0], node._domain, node._outside, node._time_shift,
+                           child_hashes))
+        node._hash_cache = (h.hexdigest(), child_hashes)
+        return node._hash_cache[0]
+    return _postorder(wav, visit)[id(wav)]
+
+_UNSET = object()
+
+def _spectral_terms(wav):
+    '''计算波形的频谱分量
+
+    每个分量 (coef, nu, tau, kernel) 表示时域上的 coef * exp(2j*pi*nu*t) * k(t-tau)，
+    kernel 为 k 的 Fourier 变换；kernel 为 None 时 k = 1，即频率为 nu 的谱线。
+    '''
+    return _postorder(wav, lambda node, structure, children: node._spectrum(children))[id(wav)]
+
+def _spectral_shift(terms, t):
+    return [(coef*np.exp(-2j*np.pi*nu*t), nu, tau+t, kernel) for coef, nu, tau, kernel in terms]
+
+def _spectral_product(a, b):
+    terms = []
+    for ca, nua, taua, ka in a:
+        for cb, nub, taub, kb in b:
+            if ka is not None and kb is not None:
+                raise TypeError('product of two waveforms with continuous spectra has no analytic spectrum')
+            tau, kernel = (taua, ka) if ka is not None else (taub, kb)
+            terms.append((ca*cb, nua+nub, tau, kernel))
+    return terms
+
+class SampleCache():
+    '''按 (结构哈希, 采样率, 范围, 数据类型) 缓存已生成的波形数据
+
+    maxbytes: 缓存占用内存的上限，超出时按 LRU 顺序淘汰
+
+    put 不复制数据而是将其设为只读后直接保存（超出 maxbytes 而不保存的数组同样设为只读），
+    get 返回的也是这一只读数组。
+    '''
+    def __init__(self, maxbytes=256*2**20):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        data = self._data.get(key, None)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        data.setflags(write=False)
+        if key in self._data or data.nbytes > self.maxbytes:
+            return
+        self._data[key] = data
+        self.nbytes += data.nbytes
+        while self.nbytes > self.maxbytes:
+            _, old = self._data.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data),
+                    nbytes=self.nbytes, maxbytes=self.maxbytes)
+
+sample_cache = SampleCache()
+
 class Waveform():
     def __init__(self, domain=(0,1), outside=(0,0)):
         '''
@@ -28,6 +545,7 @@ class Waveform():
         self._timeFunc_domain = (-np.inf, np.inf)
         self._outside = outside
         self._time_shift = 0
+        self._hash_cache = _UNSET
         self.timeFunc = lambda x : 0
 
     def _mask(self, x):
@@ -51,139 +569,348 @@ class Waveform():
         x = mask*(x-self._time_shift)+self.__a_point_in_timeFunc_domain()*(fmask+bmask)
         return fmask*self._outside[0] + bmask*self._outside[1] + mask*self.timeFunc(x)
 
-    def generateData(self, sampleRate, with_x=False):
+    def _support(self):
+        '''返回 (start, stop, left, right)
+
+        在 [start, stop] 之外，波形取值严格等于常数：x < start 时为 left，x > stop 时为 right。
+        '''
+        start, stop = self._timeFunc_domain
+        return start, stop, self._outside[0], self._outside[1]
+
+    def _render(self, x, out, shift):
+        '''将 x - shift 处的取值写入 out
+
+        x 为升序排列的采样点，只在 _support 给出的区间内计算 timeFunc，
+        其余采样点直接填充常数。
+        '''
+        start, stop, left, right = self._support()
+        t = shift + self._time_shift
+        lo = max(int(np.searchsorted(x, np.min(start+t), 'left'))-1, 0)
+        hi = min(int(np.searchsorted(x, np.max(stop+t), 'right'))+1, len(x))
+        out[..., :lo] = left
+        out[..., hi:] = right
+        if lo >= hi:
+            return
+        if self._timeFunc_domain == (-np.inf, np.inf):
+            out[..., lo:hi] = self.timeFunc(x[lo:hi]-shift-self._time_shift)
+        else:
+            out[..., lo:hi] = self._timeFunc(x[lo:hi]-shift)
+
+    def _emit(self, compiler, shift, window, dst):
+        compiler.emit(_LEAF, window, dst, compiler.bind(self), shift)
+
+    def _params(self):
+        '''返回作为参数的 Param'''
+        return []
+
+    def _bind(self, value):
+        '''返回用 value(p) 替换各个 Param 之后的波形'''
+        return self
+
+    def _structure(self):
+        '''返回 (参数, 子节点列表)，用于计算结构哈希
+
+        timeFunc 为任意函数时无法判断两个波形是否相同，返回 None 表示不可缓存。
+        '''
+        return None
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        '''由 _structure 给出的参数和子节点重建波形'''
+        raise TypeError('%s can not be rebuilt from its structure' % cls.__name__)
+
+    def to_spec(self, portable=False):
+        '''返回描述该波形的扁平列表，可用 Waveform.from_spec 重建
+
+        列表中每一项为 [类型, 参数, 子节点序号, 定义域, outside]，按后序排列，最后一项为根节点，
+        共用的子树只记录一次。timeFunc 为任意函数的波形无法描述，抛出 TypeError。
+        portable 为真时参数中的数组和 Param 也转换为列表和字典，结果可直接用 json 或 msgpack 编码。
+        '''
+        spec = []
+        def visit(node, structure, children):
+            if structure is None:
+                raise TypeError('%s with an arbitrary timeFunc has no spec' % type(node).__name__)
+            item = [type(node).__name__, structure[0], children,
+                    list(node._domain), list(node._outside)]
+            spec.append(_spec_encode(item) if portable else item)
+            return len(spec) - 1
+        _postorder(self, visit)
+        return spec
+
+    @staticmethod
+    def from_spec(spec):
+        '''由 to_spec 给出的列表重建波形'''
+        nodes = []
+        for name, params, children, domain, outside in spec:
+            node = _spec_types[name]._from_structure(_spec_decode(params),
+                                                     [nodes[i] for i in children])
+            node._domain = tuple(_spec_decode(domain))
+            node._outside = tuple(_spec_decode(outside))
+            nodes.append(node)
+        return nodes[-1]
+
+    def to_json(self):
+        '''返回波形的 JSON 描述，可用 Waveform.from_json 重建'''
+        return json.dumps(self.to_spec(portable=True), separators=(',', ':'))
+
+    @staticmethod
+    def from_json(s):
+        return Waveform.from_spec(json.loads(s))
+
+    def __reduce_ex__(self, protocol):
+        # timeFunc 为 lambda 时无法直接 pickle，通过 spec 传递；扁平的 spec 也避免了深层递归
+        try:
+            spec = self.to_spec()
+        except TypeError:
+            return super(Waveform, self).__reduce_ex__(protocol)
+        return (Waveform.from_spec, (spec,))
+
+    def structural_hash(self):
+        '''由节点类型、参数、平移量和定义域计算的哈希，波形无法哈希时返回 None'''
+        return _structural_hash(self)
+
+    def _registers(self, children):
+        '''由子节点所需的寄存器数目 children 计算本节点展开时所需的数目'''
+        return max(children, default=1)
+
+    def _piecewise(self, children):
+        '''子节点是否为分段常数由 children 给出，返回本节点是否为分段常数'''
+        return False
+
+    def _bounds(self, children):
+        '''由子节点的 _bounds 计算本节点（未平移时）的 (start, stop, left, right)
+
+        x < start 时取值恒为 left，x > stop 时恒为 right；无法确定时返回 None。
+        '''
+        if children:
+            return None
+        start, stop, left, right = self._support()
+        if not (np.isfinite(start) and np.isfinite(stop)):
+            return None
+        return start+self._time_shift, stop+self._time_shift, left, right
+
+    def _pieces_children(self, shift):
+        '''返回 [(子节点, 子节点的平移量), ...]，见 _pieces'''
+        return []
+
+    def _pieces(self, shift, children, locate):
+        '''由子节点的分段计算本节点在平移 shift 后的分段'''
+        raise TypeError('%s is not piecewise constant' % type(self).__name__)
+
+    def segments(self):
+        '''分段常数的波形在其定义域内的各段 [(start, stop, value), ...]
+
+        DC, 宽度为零的 Step 以及它们的和、积、平移、拼接和覆盖都是分段常数，
+        其他波形抛出 TypeError。
+        '''
+        if not _piecewise_table(self)[id(self)]:
+            raise TypeError('%s is not piecewise constant' % type(self).__name__)
+        keys, values = _pieces(self, 0, _time_locate)
+        start, stop = self._domain
+        ret = []
+        for (t, right), value in zip(keys + [(np.inf, False)], values):
+            if t > start:
+                ret.append((start, min(t, stop), float(value)))
+                start = t
+            if start >= stop:
+                break
+        return ret
+
+    def runs(self, sampleRate):
+        '''按 generateData 的采样网格给出分段常数波形的游程 [(value, count), ...]
+
+        AWG 的序列可以直接用这些 (取值, 重复次数) 作为各步，无需上传全部采样点。
+        '''
+        if not _piecewise_table(self)[id(self)]:
+            raise TypeError('%s is not piecewise constant' % type(self).__name__)
+        grid = _Grid(self._domain[0], self._domain[1], 1.0/sampleRate)
+        keys, values = _pieces(self, 0, _grid_locate(grid))
+        ret = []
+        for start, stop, value in zip([0] + keys, keys + [grid.size], values):
+            if stop <= start:
+                continue
+            if ret and ret[-1][0] == value:
+                ret[-1] = (ret[-1][0], ret[-1][1] + stop - start)
+            else:
+                ret.append((float(value), stop - start))
+        return ret
+
+    def _spectrum(self, children):
+        '''由子节点的频谱分量计算本节点的频谱分量，见 _spectral_terms'''
+        raise TypeError('%s has no analytic spectrum' % type(self).__name__)
+
+    def spectrum(self, f):
+        '''波形的 Fourier 变换 F(f) = ∫ w(t) exp(-2j*pi*f*t) dt 中的连续部分
+
+        由各基本波形的解析表达式得到，无需在时域上采样。平移对应相位因子，
+        与 Cos, Sin 或常数的乘积对应频移。计算的是整条时间轴上的波形，不受 set_range 的限制；
+        谱线（δ 函数）部分由 spectrum_lines 给出。Concat, Repeat, Overwrite 以及两个连续谱之积
+        没有解析形式，抛出 TypeError。Step 的频谱在 f = 0 处取主值。
+        '''
+        f = np.asarray(f, dtype=float)
+        F = np.zeros(f.shape, dtype=complex)
+        for coef, nu, tau, kernel in _spectral_terms(self):
+            if kernel is not None:
+                F += coef * np.exp(-2j*np.pi*(f-nu)*tau) * kernel(f-nu)
+        return F
+
+    def spectrum_lines(self):
+        '''返回频谱中的谱线 [(频率, 复振幅), ...]，按频率排序，频率相同的谱线已合并'''
+        lines = {}
+        for coef, nu, tau, kernel in _spectral_terms(self):
+            if kernel is None:
+                lines[float(nu)] = lines.get(float(nu), 0) + complex(coef)
+        return sorted(lines.items())
+
+    def _compile(self):
+        return _Compiler().compile(self)
+
+    def generateData(self, sampleRate, with_x=False, cache=False, chunk=None):
+        '''生成波形数据
+
+        sampleRate: 采样率
+        with_x    : 是否同时返回采样时间
+        cache     : 是否使用 sample_cache，此时返回的数组总是只读的（可能与缓存共用），
+                    需要修改时先 copy()；默认不使用，返回可以修改的新数组
+        chunk     : 若给出，返回一个生成器，依次给出长度为 chunk 的各段数据，
+                    拼接后与一次性生成的结果逐位一致
+        '''
+        if chunk is not None:
+            return self._generateChunks(sampleRate, with_x, int(chunk))
+        x = np.arange(self._domain[0], self._domain[1], 1.0/sampleRate)
+        grid = _Grid(self._domain[0], self._domain[1], 1.0/sampleRate)
+        key = self.structural_hash() if cache else None
+        if key is not None:
+            key = (key, sampleRate, self._domain, 'float64')
+            y = sample_cache.get(key)
+            if y is None:
+                y = self._compile().execute(x, grid=grid)
+                sample_cache.put(key, y)
+        else:
+            y = self._compile().execute(x, grid=grid)
+            if cache:
+                y.setflags(write=False)
+        if with_x:
+            return x, y
+        else:
+            return y
+
+    def _generateChunks(self, sampleRate, with_x, chunk):
+        grid = _Grid(self._domain[0], self._domain[1], 1.0/sampleRate)
+        plan = self._compile()
+        for i in range(0, grid.size, chunk):
+            x = grid.x(i, min(i+chunk, grid.size))
+            y = plan.execute(x, grid=grid, offset=i)
+            if with_x:
+                yield x, y
+            else:
+                yield y
+
+    def generateSamples(self, sampleRate, dtype='int16', scale=1.0, offset=0, clip=None,
+                        markers={}, out=None, chunk=2**16):
+        '''生成可直接送往 DAC 的采样数据
+
+        波形按 chunk 分段计算，每段在同一块浮点缓冲区中完成缩放、截断、平移和
+        marker 打包后写入 out，不产生整段的浮点数据。
+
+        dtype  : 目标数据类型，如 int16, uint16, float32
+        markers: {bit: marker}，marker 为 Waveform 或与波形等长的数组
+        out    : 存放结果的数组，不给出时新建
+
+        其余参数见 qulab.util.quantize
+        '''
+        grid = _Grid(self._domain[0], self._domain[1], 1.0/sampleRate)
+        if out is None:
+            out = np.empty(grid.size, dtype=dtype)
+        plan = self._compile()
+        marker_plans = {bit: m._compile() for bit, m in markers.items() if isinstance(m, Waveform)}
+        buff = np.empty(min(chunk, grid.size))
+        for i in range(0, grid.size, chunk):
+            j = min(i+chunk, grid.size)
+            x = grid.x(i, j)
+            y = plan.execute(x, out=buff[:j-i], grid=grid, offset=i)
+            chunk_markers = {bit: (marker_plans[bit].execute(x, grid=grid, offset=i)
+                                   if bit in marker_plans else marker[i:j])
+                             for bit, marker in markers.items()}
+            quantize(y, scale=scale, offset=offset, clip=clip, markers=chunk_markers,
+                     out=out[i:j], copy=False)
+        return out
+
+    def generateBatch(self, sampleRate, with_x=False, **params):
+        '''对参数扫描批量生成波形
+
+        params: 参数名称及其取值列表，各列表长度相同（或为标量）
+
+        返回形如 (n_params, n_samples) 的数组，第 i 行为各 Param 取第 i 个值时的波形。
+        '''
+        names = list(params.keys())
+        arrays = np.broadcast_arrays(*[np.asarray(params[k], dtype=float).reshape(-1)
+                                       for k in names])
+        values = {k: v.reshape(-1, 1) for k, v in zip(names, arrays)}
+        batch = (len(arrays[0]),) if arrays else (1,)
         x = np.arange(self._domain[0], self._domain[1], 1.0/sampleRate)
+        grid = _Grid(self._domain[0], self._domain[1], 1.0/sampleRate)
+        y = _Compiler(values).compile(self).execute(x, grid=grid, batch=batch)
         if with_x:
-            return x, self._timeFunc(x)
+            return x, y
         else:
-            return self._timeFunc(x)
-
-    def _comb_waveform(self, other):
-        domain = _comb_domain(self._domain, other._domain)
-        outside = _comb_outside(self._domain, other._domain, self._outside, other._outside)
-        w = Waveform(domain=domain, outside=outside)
-        start = min(self._timeFunc_domain[0], other._timeFunc_domain[0])
-        stop = max(self._timeFunc_domain[1], other._timeFunc_domain[1])
-        w._timeFunc_domain = (start, stop)
-        #w._timeFunc_domain = self._comb_timeFunc_domain(other)
-        #w._time_shift = self._time_shift
-        return w
+            return y
 
     def __call__(self, x):
-        return self._timeFunc(x)
+        x = np.asarray(x, dtype=float)
+        t = x.ravel()
+        order = np.argsort(t, kind='stable')
+        y = np.empty_like(t)
+        y[order] = self._compile().execute(t[order])
+        return y.reshape(x.shape)
 
     def __add__(self, other):
-        if isinstance(other, Waveform):
-            w = self._comb_waveform(other)
-            w.timeFunc = lambda x : self._timeFunc(x) + other._timeFunc(x)
-            w._outside = (self._outside[0]+other._outside[0], self._outside[1]+other._outside[1])
-            return w
-        else:
-            return other + self
+        return Sum(self, other)
 
     def __radd__(self, v):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : v + self._timeFunc(x)
-        w._outside = (self._outside[0]+v, self._outside[1]+v)
-        return w
+        return Sum(v, self)
 
     def __sub__(self, other):
-        if isinstance(other, Waveform):
-            w = self._comb_waveform(other)
-            w.timeFunc = lambda x : self._timeFunc(x) - other._timeFunc(x)
-            w._outside = (self._outside[0]-other._outside[0], self._outside[1]-other._outside[1])
-            return w
-        else:
-            return - other + self
+        return Operator(np.subtract, self, other)
 
     def __rsub__(self, v):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : v - self._timeFunc(x)
-        w._outside = (v-self._outside[0], v-self._outside[1])
-        return w
+        return Operator(np.subtract, v, self)
 
     def __mul__(self, other):
-        if isinstance(other, Waveform):
-            w = self._comb_waveform(other)
-            w.timeFunc = lambda x : self._timeFunc(x) * other._timeFunc(x)
-            w._outside = (self._outside[0]*other._outside[0], self._outside[1]*other._outside[1])
-            return w
-        else:
-            return other * self
+        return Product(self, other)
 
     def __rmul__(self, v):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : v * self._timeFunc(x)
-        w._outside = (self._outside[0]*v, self._outside[1]*v)
-        return w
+        return Product(v, self)
 
     def __truediv__(self, other):
-        if isinstance(other, Waveform):
-            w = self._comb_waveform(other)
-            w.timeFunc = lambda x : self._timeFunc(x) / other._timeFunc(x)
-            w._outside = (self._outside[0]*other._outside[0], self._outside[1]*other._outside[1])
-            return w
-        else:
-            return (1/other) * self
+        return Operator(np.true_divide, self, other)
 
     def __rtruediv__(self, v):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : v / self._timeFunc(x)
-        w._outside = (v/self._outside[0], v/self._outside[1])
-        return w
+        return Operator(np.true_divide, v, self)
 
     def __pow__(self, v):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : self._timeFunc(x)**v
-        w._outside = (self._outside[0]**v, self._outside[1]**v)
-        return w
+        return Operator(np.power, self, v)
 
     def __pos__(self):
         return self
 
     def __neg__(self):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : - self._timeFunc(x)
-        w._outside = (-self._outside[0], -self._outside[1])
-        return w
+        return Operator(np.negative, self)
 
     def __abs__(self):
-        #w = copy.deepcopy(self)
-        w = Waveform(domain=self._domain, outside=self._outside)
-        w.timeFunc = lambda x : abs(self._timeFunc(x))
-        w._outside = (abs(self._outside[0]), abs(self._outside[1]))
-        return w
+        return Operator(np.absolute, self)
 
     def __or__(self, other):
-        w = Waveform((self._domain[0], self._domain[1]+other.len()))
-        w._time_shift = self._time_shift
-        w._outside = (self._outside[0], other._outside[1])
-        #w.timeFunc = lambda x: self._timeFunc(x) if x < self._domain[1] else other._timeFunc(x-self._domain[1]+other._domain[0])
-        w.timeFunc = lambda x: self._timeFunc(x) * (x < self._domain[1]) + other._timeFunc(x-self._domain[1]+other._domain[0]) * (x >= self._domain[1])
-        return w
+        return Concat(self, other)
 
     def __xor__(self, n):
         n = int(n)
         if n <= 1:
             return self
-        w = copy.deepcopy(self)
-        #w = Waveform(domain=self._domain, outside=self._outside)
-        for i in range(n-1):
-            w = w | self
-        return w
+        return Repeat(self, n)
 
     def __rshift__(self, t):
-        w = copy.deepcopy(self)
-        w._time_shift = self._time_shift + t
-        w._domain = (self._domain[0]+t, self._domain[1]+t)
-        w._timeFunc_domain = (self._timeFunc_domain[0], self._timeFunc_domain[1])
-        return w
+        return Shift(self, t)
 
     def __lshift__(self, t):
         return self >> (-t)
@@ -192,13 +919,11 @@ class Waveform():
         return self._domain[1] - self._domain[0]
 
     def overwrite(self, other):
-        w = self._comb_waveform(other)
-        w.timeFunc = lambda x : other._timeFunc(x) * (x >= other._domain[0])*( x <= other._domain[1]) \
-                          + self._timeFunc(x) * ((x >= other._domain[0])+( x <= other._domain[1]))
-        return w
+        return Overwrite(self, other)
 
     def set_range(self, t1, t2):
         self._domain = (t1, t2)
+        self._hash_cache = _UNSET
         return self
 
     def plot(self, n=1000):
@@ -206,6 +931,353 @@ class Waveform():
         x, y = self.generateData(sampleRate, with_x=True)
         plt.plot(x, y)
 
+class Operator(Waveform):
+    '''逐点运算节点
+
+    ufunc   : numpy 的一元或二元 ufunc
+    operands: 运算数，Waveform 或标量
+    '''
+    def __init__(self, ufunc, *operands):
+        wavs = [o for o in operands if isinstance(o, Waveform)]
+        domain = reduce(_comb_domain, [w._domain for w in wavs])
+        with np.errstate(all='ignore'):
+            outside = tuple(float(ufunc(*[o._outside[i] if isinstance(o, Waveform) else o
+                                          for o in operands])) for i in range(2))
+        super(Operator, self).__init__(domain=domain, outside=outside)
+        self.ufunc = ufunc
+        self.operands = operands
+
+    def _structure(self):
+        return ((self.ufunc.__name__, [None if isinstance(o, Waveform) else o for o in self.operands]),
+                [o for o in self.operands if isinstance(o, Waveform)])
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        name, operands = params
+        children = iter(children)
+        operands = [next(children) if o is None else o for o in operands]
+        if cls is Operator:
+            return Operator(getattr(np, name), *operands)
+        return cls(*operands)
+
+    def _emit(self, compiler, shift, window, dst):
+        if len(self.operands) == 1:
+            compiler.defer(lambda: compiler.emit(_UNARY, window, dst, self.ufunc))
+            compiler.push(self.operands[0], shift, window, dst)
+            return
+        if len(self.operands) > 2:
+            self._emit_nary(compiler, shift, window, dst)
+            return
+        a, b = self.operands
+        if not isinstance(b, Waveform):
+            v = compiler.value(b)
+            compiler.defer(lambda: compiler.emit(_SCALAR, window, dst, self.ufunc, v, False))
+            compiler.push(a, shift, window, dst)
+        elif not isinstance(a, Waveform):
+            v = compiler.value(a)
+            compiler.defer(lambda: compiler.emit(_SCALAR, window, dst, self.ufunc, v, True))
+            compiler.push(b, shift, window, dst)
+        else:
+            # 先展开所需寄存器较多的运算数（Sethi–Ullman 顺序），另一个运算数的
+            # 寄存器在其展开完毕之后才分配，使左深与右深的长链都只占用一个临时缓冲区
+            reverse = compiler.registers.get(id(b), 1) > compiler.registers.get(id(a), 1)
+            first, second = (b, a) if reverse else (a, b)
+            part = window
+            if self.ufunc is np.add or (self.ufunc is np.subtract and not reverse):
+                # 加上（减去）一个在某范围之外恒为零的波形，只需计算这一范围
+                part = compiler.sparse(second, shift, window) or window
+            reg = [None]
+            def later():
+                reg[0] = compiler.alloc()
+                compiler.push(second, shift, part, reg[0])
+            def combine():
+                compiler.emit(_BINARY, part, dst, self.ufunc, reg[0], reverse)
+                compiler.release(reg[0])
+            compiler.defer(combine)
+            compiler.defer(later)
+            compiler.push(first, shift, window, dst)
+
+    def _registers(self, children):
+        if len(children) == 2 and len(self.operands) == 2:
+            a, b = children
+            return max(a, b) if a != b else a + 1
+        return max([children[0]] + [c + 1 for c in children[1:]])
+
+    def _piecewise(self, children):
+        return all(children)
+
+    def _bounds(self, children):
+        bounds = iter(children)
+        operands = [next(bounds) if isinstance(o, Waveform) else o for o in self.operands]
+        zeros = [b for b in children if b is not None and b[2] == 0 == b[3]]
+        if self.ufunc is np.multiply and zeros:
+            # 乘积在恒为零的因子的范围之外恒为零，其余因子在那里的取值不影响结果
+            start = max(b[0] for b in zeros)
+            stop = max(start, min(b[1] for b in zeros))
+            operands = [1 if o is None else o for o in operands]
+        elif None not in children:
+            start, stop = min(b[0] for b in children), max(b[1] for b in children)
+        else:
+            return None
+        # 两侧的常数按逐点计算时的运算顺序求出
+        if len(operands) > 2:
+            operands = ([o for o in operands if isinstance(o, tuple)] +
+                        [o for o in operands if not isinstance(o, tuple)])
+        outside = []
+        for i in (2, 3):
+            args = [o[i] if isinstance(o, tuple) else o for o in operands]
+            with np.errstate(all='ignore'):
+                outside.append(float(reduce(self.ufunc, args) if len(args) > 1 else self.ufunc(args[0])))
+        return (start, stop) + tuple(outside)
+
+    def _pieces_children(self, shift):
+        return [(o, shift) for o in self.operands if isinstance(o, Waveform)]
+
+    def _pieces(self, shift, children, locate):
+        children = iter(children)
+        return _pieces_combine(self.ufunc, [next(children) if isinstance(o, Waveform) else o
+                                            for o in self.operands])
+
+    def _spectrum(self, children):
+        ufunc = self.ufunc
+        children = iter(children)
+        operands = [next(children) if isinstance(o, Waveform) else [(float(o), 0, 0, None)]
+                    for o in self.operands]
+        if ufunc is np.add:
+            return [term for terms in operands for term in terms]
+        elif ufunc is np.multiply:
+            return reduce(_spectral_product, operands)
+        elif ufunc is np.negative:
+            return [(-coef, nu, tau, kernel) for coef, nu, tau, kernel in operands[0]]
+        elif ufunc is np.subtract:
+            a, b = operands
+            return a + [(-coef, nu, tau, kernel) for coef, nu, tau, kernel in b]
+        elif ufunc is np.true_divide and not isinstance(self.operands[1], Waveform):
+            return [(coef/float(self.operands[1]), nu, tau, kernel)
+                    for coef, nu, tau, kernel in operands[0]]
+        return super(Operator, self)._spectrum(children)
+
+    def _emit_nary(self, compiler, shift, window, dst):
+        # 只有 Sum 与 Product 有两个以上的运算数，运算满足交换律：
+        # 各波形依次累加（乘）到 dst 中，共用一个临时缓冲区，最后再作用标量
+        wavs = [o for o in self.operands if isinstance(o, Waveform)]
+        for v in reversed([o for o in self.operands if not isinstance(o, Waveform)]):
+            compiler.defer(lambda v=compiler.value(v):
+                           compiler.emit(_SCALAR, window, dst, self.ufunc, v, False))
+        for w in reversed(wavs[1:]):
+            reg = [None]
+            part = window
+            if self.ufunc is np.add:
+                part = compiler.sparse(w, shift, window) or window
+            def second(w=w, reg=reg, part=part):
+                reg[0] = compiler.alloc()
+                compiler.push(w, shift, part, reg[0])
+            def combine(reg=reg, part=part):
+                compiler.emit(_BINARY, part, dst, self.ufunc, reg[0], False)
+                compiler.release(reg[0])
+            compiler.defer(combine)
+            compiler.defer(second)
+        compiler.push(wavs[0], shift, window, dst)
+
+class _Accumulate(Operator):
+    '''满足结合律与交换律的多元运算节点
+
+    构造时展开同类的子节点，并将其中的常数合并为一个，放在运算数的最后；
+    Param 不参与合并。运算数中只有一个波形时保留合并后的常数。
+    '''
+    ufunc = None
+    identity = None
+
+    def __init__(self, *operands):
+        wavs, const = [], self.identity
+        for o in operands:
+            if type(o) is type(self) and o._domain == o._natural_domain:
+                last = o.operands[-1]
+                if isinstance(last, Waveform) or isinstance(last, Param):
+                    wavs.extend(o.operands)
+                else:
+                    wavs.extend(o.operands[:-1])
+                    const = self._fold(const, last)
+            elif isinstance(o, Waveform) or isinstance(o, Param):
+                wavs.append(o)
+            else:
+                const = self._fold(const, o)
+        if const != self.identity or len(wavs) < 2:
+            wavs.append(const)
+        domain = reduce(_comb_domain, [o._domain for o in operands if isinstance(o, Waveform)])
+        with np.errstate(all='ignore'):
+            outside = tuple(float(reduce(self.ufunc, [o._outside[i] if isinstance(o, Waveform) else o
+                                                      for o in operands])) for i in range(2))
+        Waveform.__init__(self, domain=domain, outside=outside)
+        self._natural_domain = domain
+        self.operands = tuple(wavs)
+
+    def _fold(self, a, b):
+        v = self.ufunc(a, b)
+        return v.item() if isinstance(v, np.generic) else v
+
+class Sum(_Accumulate):
+    ufunc = np.add
+    identity = 0
+
+class Product(_Accumulate):
+    ufunc = np.multiply
+    identity = 1
+
+class Shift(Waveform):
+    '''平移节点，取值为 wav(x - t)'''
+    def __init__(self, wav, t):
+        if isinstance(wav, Shift) and not isinstance(wav.t, Param) and not isinstance(t, Param):
+            wav, t = wav.wav, wav.t + t
+        super(Shift, self).__init__(domain=(wav._domain[0]+t, wav._domain[1]+t),
+                                    outside=wav._outside)
+        self.wav = wav
+        self.t = t
+
+    def _structure(self):
+        return self.t, [self.wav]
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return Shift(children[0], params)
+
+    def _emit(self, compiler, shift, window, dst):
+        compiler.push(self.wav, shift+compiler.value(self.t), window, dst)
+
+    def _spectrum(self, children):
+        return _spectral_shift(children[0], float(self.t))
+
+    def _piecewise(self, children):
+        return children[0]
+
+    def _pieces_children(self, shift):
+        return [(self.wav, shift+self.t)]
+
+    def _bounds(self, children):
+        if children[0] is None:
+            return None
+        start, stop, left, right = children[0]
+        return start+self.t, stop+self.t, left, right
+
+    def _pieces(self, shift, children, locate):
+        return children[0]
+
+class Concat(Waveform):
+    '''拼接节点，a 的定义域结束之后接上 b'''
+    def __init__(self, a, b):
+        super(Concat, self).__init__(domain=(a._domain[0], a._domain[1]+b.len()),
+                                     outside=(a._outside[0], b._outside[1]))
+        self.a = a
+        self.b = b
+
+    def _structure(self):
+        return (), [self.a, self.b]
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return Concat(*children)
+
+    def _piecewise(self, children):
+        return all(children)
+
+    def _pieces_children(self, shift):
+        return [(self.a, shift), (self.b, shift+self.a._domain[1]-self.b._domain[0])]
+
+    def _pieces(self, shift, children, locate):
+        a, b = children
+        return _pieces_stitch([(a, locate(self.a._domain[1]+shift, 'left', 0)), (b, None)])
+
+    def _emit(self, compiler, shift, window, dst):
+        _check_scalar_shift(shift)
+        split = (self.a._domain[1]+shift, 'left')
+        compiler.push(self.b, shift+self.a._domain[1]-self.b._domain[0],
+                      _intersect(window, lower=split), dst)
+        compiler.push(self.a, shift, _intersect(window, upper=split), dst)
+
+class Repeat(Waveform):
+    '''将 wav 首尾相接重复 n 次'''
+    def __init__(self, wav, n):
+        super(Repeat, self).__init__(domain=(wav._domain[0], wav._domain[0]+n*wav.len()),
+                                     outside=wav._outside)
+        self.wav = wav
+        self.n = n
+
+    def _structure(self):
+        return self.n, [self.wav]
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return Repeat(children[0], params)
+
+    def _emit(self, compiler, shift, window, dst):
+        _check_scalar_shift(shift)
+        plan = _Compiler(compiler.values).compile(self.wav)
+        compiler.emit(_REPEAT, window, dst, self, plan, shift)
+
+    def _render_repeat(self, plan, x, out, shift, grid, offset):
+        period = self.wav.len()
+        start = self.wav._domain[0] + shift
+        last = shift + (self.n-1)*period
+        # 第一段与最后一段还包含定义域之外的部分，直接计算
+        a = int(np.searchsorted(x, start+period, 'left'))
+        b = max(a, int(np.searchsorted(x, start+(self.n-1)*period, 'left')))
+        plan.execute(x[:a]-shift, out[..., :a], grid and grid.shifted(shift), offset)
+        plan.execute(x[b:]-last, out[..., b:], grid and grid.shifted(last), offset+b)
+        if a == b:
+            return
+        size = round(period/grid.delta) if grid is not None else 0
+        if size > 0 and abs(period/grid.delta - size) < 1e-6:
+            ga = grid.index(start+period, 'left')
+            gb = grid.index(start+(self.n-1)*period, 'left')
+        if size > 0 and abs(period/grid.delta - size) < 1e-6 and gb - ga >= size:
+            # 周期为整数个采样点，只计算一个周期，然后平铺
+            # 平铺的起点取在整个网格上，使分段计算的结果与一次性计算一致
+            base_grid = grid.shifted(shift+period)
+            base = plan.execute(base_grid.x(ga, ga+size), grid=base_grid, offset=ga,
+                                batch=out.shape[:-1])
+            _tile(out[..., a:b], base, (offset + a - ga) % size)
+        else:
+            # 按周期取模后统一计算
+            k = np.clip(np.floor((x[a:b]-start)/period), 1, self.n-2)
+            t = x[a:b] - shift - k*period
+            order = np.argsort(t, kind='stable')
+            out[..., a:b][..., order] = plan.execute(t[order], batch=out.shape[:-1])
+
+class Overwrite(Waveform):
+    '''在 other 的定义域内用 other 覆盖 wav'''
+    def __init__(self, wav, other):
+        super(Overwrite, self).__init__(domain=_comb_domain(wav._domain, other._domain),
+            outside=_comb_outside(wav._domain, other._domain, wav._outside, other._outside))
+        self.wav = wav
+        self.other = other
+
+    def _structure(self):
+        return (), [self.wav, self.other]
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return Overwrite(*children)
+
+    def _piecewise(self, children):
+        return all(children)
+
+    def _pieces_children(self, shift):
+        return [(self.wav, shift), (self.other, shift)]
+
+    def _pieces(self, shift, children, locate):
+        wav, other = children
+        return _pieces_stitch([(wav, locate(self.other._domain[0]+shift, 'left', 0)),
+                               (other, locate(self.other._domain[1]+shift, 'right', 0)),
+                               (wav, None)])
+
+    def _emit(self, compiler, shift, window, dst):
+        _check_scalar_shift(shift)
+        start, stop = self.other._domain[0]+shift, self.other._domain[1]+shift
+        compiler.push(self.wav, shift, _intersect(window, upper=(start, 'left')), dst)
+        compiler.push(self.wav, shift, _intersect(window, lower=(stop, 'right')), dst)
+        compiler.push(self.other, shift,
+                      _intersect(window, lower=(start, 'left'), upper=(stop, 'right')), dst)
+
 class DC(Waveform):
     def __init__(self, offset, length=0, range=(0,1)):
         if length <= 0:
@@ -218,27 +1290,137 @@ class DC(Waveform):
         self._DC = offset
         self.timeFunc = lambda x: self._DC * (x > self.start) * (x < self.stop)
 
+    def _support(self):
+        return self.start, self.stop, 0, 0
+
+    def _structure(self):
+        return (self._DC, self.start, self.stop), []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        offset, start, stop = params
+        return DC(offset, range=(start, stop))
+
+    def _params(self):
+        return [v for v in [self._DC] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return DC(value(self._DC), range=(self.start, self.stop))
+
+    def _piecewise(self, children):
+        return True
+
+    def _pieces(self, shift, children, locate):
+        return _pieces_simplify([locate(self.start, 'right', shift), locate(self.stop, 'left', shift)],
+                                [0.0, float(self._DC), 0.0])
+
+    def _spectrum(self, children):
+        a, b = self.start, self.stop
+        if np.isinf(a) and np.isinf(b):
+            return [(float(self._DC), 0, 0, None)]
+        elif np.isinf(a) or np.isinf(b):
+            return super(DC, self)._spectrum(children)
+        return [(float(self._DC), 0, 0.5*(a+b), lambda f: (b-a)*np.sinc((b-a)*f))]
+
     #def _timeFunc(self, x):
     #    x = x - self._time_shift
     #    return self._DC * (x > self.start) * (x < self.stop)
 
 class Interpolation(Waveform):
+    '''由采样点插值得到的波形
+
+    插值函数在构造时一次建好：linear 使用 np.interp，slinear, quadratic, cubic 使用
+    make_interp_spline 得到的 B 样条，其余 kind 使用 interp1d。数据表很长时每次求值也没有额外的准备开销。
+    '''
     def __init__(self, x, y, interpolation='linear', **kw):
         super(Interpolation, self).__init__(domain = (x[0], x[-1]), **kw)
         self.xy = (x,y)
-        self.timeFunc = interpolate.interp1d(x, y, kind=interpolation)
+        self.kind = interpolation
+        xp, fp = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if np.any(xp[1:] < xp[:-1]):
+            order = np.argsort(xp, kind='stable')
+            xp, fp = xp[order], fp[order]
+        if interpolation == 'linear':
+            self.timeFunc = lambda t: np.interp(t, xp, fp)
+        elif interpolation in self._spline_order:
+            self.timeFunc = interpolate.make_interp_spline(xp, fp, k=self._spline_order[interpolation])
+        else:
+            self.timeFunc = interpolate.interp1d(xp, fp, kind=interpolation, assume_sorted=True)
         self._timeFunc_domain = self._domain
 
+    _spline_order = {'slinear': 1, 'quadratic': 2, 'cubic': 3}
+
+    def _render(self, x, out, shift):
+        t = shift + self._time_shift
+        if np.ndim(t) != 0:
+            return super(Interpolation, self)._render(x, out, shift)
+        # 与 _timeFunc 相同，定义域为开区间，端点上取 outside 的值
+        start, stop = self._timeFunc_domain
+        i0 = max(int(np.searchsorted(x, start+t, 'right'))-1, 0)
+        i1 = min(int(np.searchsorted(x, stop+t, 'left'))+1, len(x))
+        u = x[i0:i1] - t
+        lo = i0 + int(np.searchsorted(u, start, 'right'))
+        hi = i0 + int(np.searchsorted(u, stop, 'left'))
+        out[..., :lo] = self._outside[0]
+        out[..., hi:] = self._outside[1]
+        if lo < hi:
+            out[..., lo:hi] = self.timeFunc(u[lo-i0:hi-i0])
+
+    def _structure(self):
+        return (np.asarray(self.xy[0]), np.asarray(self.xy[1]), self.kind), []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        x, y, kind = params
+        return Interpolation(x, y, kind)
+
 class Step(Waveform):
     def __init__(self, width):
         super(Step, self).__init__(domain=(-0.5*width,0.5*width), outside=(0,1))
         self.width = width
-        if width == 0:
+        if np.ndim(width) == 0 and width == 0:
             self.timeFunc = lambda x: x>0
         else:
             self.timeFunc = lambda x: (erf(5*x/width)+1)/2
         #self.timeFunc = lambda t: a + (b - a) / (1 + np.exp(-(20*t)/width))
 
+    def _support(self):
+        # |5x/width| > 6 时 erf 已严格等于 ±1；width 为负时是下降沿
+        w = np.abs(self.width)
+        if np.ndim(self.width) == 0:
+            left, right = (1, 0) if self.width < 0 else (0, 1)
+        else:
+            left, right = np.where(self.width < 0, 1.0, 0.0), np.where(self.width < 0, 0.0, 1.0)
+        return -1.3*w, 1.3*w, left, right
+
+    def _structure(self):
+        return self.width, []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return cls(params)
+
+    def _params(self):
+        return [v for v in [self.width] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return Step(value(self.width))
+
+    def _piecewise(self, children):
+        return np.ndim(self.width) == 0 and self.width == 0
+
+    def _pieces(self, shift, children, locate):
+        return [locate(0, 'right', shift)], [0.0, 1.0]
+
+    def _spectrum(self, children):
+        # 导数 (5/width/sqrt(pi))*exp(-(5x/width)**2) 的变换为 exp(-(pi*f*width/5)**2)
+        width = float(self.width)
+        def kernel(f):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                F = np.exp(-(np.pi*f*width/5)**2) / (2j*np.pi*f)
+            return np.where(f == 0, 0, F)
+        return [(0.5, 0, 0, None), (1, 0, 0, kernel)]
+
 class Gaussian(Waveform):
     def __init__(self, width):
         super(Gaussian, self).__init__(domain=(-0.5*width,0.5*width))
@@ -246,22 +1428,385 @@ class Gaussian(Waveform):
         c = self.width/(4*np.sqrt(2*np.log(2)))
         self.timeFunc = lambda x: np.exp(-0.5*(x/c)**2)
 
+    def _support(self):
+        # |x| > 40|c| 时 exp(-0.5*(x/c)**2) 下溢为 0
+        c = np.abs(self.width)/(4*np.sqrt(2*np.log(2)))
+        return -40*c, 40*c, 0, 0
+
+    def _structure(self):
+        return self.width, []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return cls(params)
+
+    def _params(self):
+        return [v for v in [self.width] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return Gaussian(value(self.width))
+
+    def _spectrum(self, children):
+        c = float(self.width)/(4*np.sqrt(2*np.log(2)))
+        return [(c*np.sqrt(2*np.pi), 0, 0, lambda f: np.exp(-2*(np.pi*c*f)**2))]
+
 class Sin(Waveform):
     def __init__(self, w, phi=0):
         super(Sin, self).__init__(domain=(-np.inf, np.inf))
+        self.w = w
+        self.phi = phi
         self.timeFunc = lambda t: np.sin(w*t+phi)
 
+    def _structure(self):
+        return (self.w, self.phi), []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return cls(*params)
+
+    def _params(self):
+        return [v for v in [self.w, self.phi] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return Sin(value(self.w), value(self.phi))
+
+    def _spectrum(self, children):
+        nu, phi = float(self.w)/(2*np.pi), float(self.phi)-np.pi/2
+        return [(0.5*np.exp(1j*phi), nu, 0, None), (0.5*np.exp(-1j*phi), -nu, 0, None)]
+
 class Cos(Waveform):
     def __init__(self, w, phi=0):
         super(Cos, self).__init__(domain=(-np.inf, np.inf))
+        self.w = w
+        self.phi = phi
         self.timeFunc = lambda t: np.cos(w*t+phi)
 
+    def _structure(self):
+        return (self.w, self.phi), []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return cls(*params)
+
+    def _params(self):
+        return [v for v in [self.w, self.phi] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return Cos(value(self.w), value(self.phi))
+
+    def _spectrum(self, children):
+        nu, phi = float(self.w)/(2*np.pi), float(self.phi)
+        return [(0.5*np.exp(1j*phi), nu, 0, None), (0.5*np.exp(-1j*phi), -nu, 0, None)]
+
 class Sinc(Waveform):
     def __init__(self, a):
         super(Sinc, self).__init__(domain=(-np.inf, np.inf))
+        self.a = a
         self.timeFunc = lambda t: sinc(a*t)
 
-__all__ = ['Waveform', 'DC', 'Interpolation', 'Step', 'Gaussian', 'Sin', 'Cos', 'Sinc']
+    def _structure(self):
+        return self.a, []
+
+    @classmethod
+    def _from_structure(cls, params, children):
+        return Sinc(params)
+
+    def _params(self):
+        return [v for v in [self.a] if isinstance(v, Param)]
+
+    def _bind(self, value):
+        return Sinc(value(self.a))
+
+    def _spectrum(self, children):
+        # sinc(a*t) 的变换为宽度 |a| 的矩形，边缘处取一半
+        a = abs(float(self.a))
+        return [(1/a, 0, 0, lambda f: np.where(np.abs(f) < a/2, 1.0, np.where(np.abs(f) == a/2, 0.5, 0.0)))]
+
+_spec_types = {cls.__name__: cls for cls in [
+    Operator, Sum, Product, Shift, Concat, Repeat, Overwrite,
+    DC, Interpolation, Step, Gaussian, Sin, Cos, Sinc]}
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def _render_channel(spec, sampleRate, out=None, shm_name=None, offset=0, predistortion=None):
+    '''在工作进程（或线程）中生成一个通道的波形
+
+    给出 shm_name 时直接写入共享内存中 offset 处，否则写入 out 或返回新数组。
+    给出 predistortion 时对生成的数据作预失真。
+    '''
+    wav = Waveform.from_spec(spec) if isinstance(spec, list) else spec
+    grid = _Grid(wav._domain[0], wav._domain[1], 1.0/sampleRate)
+    shm = None
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        out = np.ndarray((grid.size,), dtype=float, buffer=shm.buf, offset=offset)
+    try:
+        y = wav._compile().execute(grid.x(0, grid.size), out=out, grid=grid)
+        if predistortion is not None:
+            y[:] = predistortion.apply(y)
+    finally:
+        if shm is not None:
+            del out
+            shm.close()
+    return None if shm is not None else y
+
+
+class SharedArray(np.ndarray):
+    '''位于共享内存中的数组
+
+    持有共享内存的引用，最后一个引用它的数组被回收时共享内存才被释放。
+    '''
+    def __array_finalize__(self, obj):
+        self._shm = getattr(obj, '_shm', None)
+
+
+# generateChannels 默认使用的执行器，(threads, processes) -> 执行器
+_channel_executors = {}
+
+def _channel_executor(threads, processes):
+    key = (bool(threads), processes)
+    if key not in _channel_executors:
+        _channel_executors[key] = (ThreadPoolExecutor if threads else ProcessPoolExecutor)(processes)
+    return _channel_executors[key]
+
+def shutdownChannelExecutors():
+    '''关闭 generateChannels 默认使用的进程池与线程池，下次调用时重新创建'''
+    while _channel_executors:
+        _, executor = _channel_executors.popitem()
+        executor.shutdown()
+
+def generateChannels(waveforms, sampleRate, processes=None, threads=False, executor=None,
+                     predistortion={}):
+    '''并行生成多个通道的波形数据
+
+    waveforms : 通道名到波形的字典
+    sampleRate: 采样率
+    processes : 工作进程（线程）数，默认为 CPU 数
+    threads   : 使用线程池而非进程池，波形主要由 numpy 运算构成时 GIL 的影响不大
+    executor  : 可以给出已有的 concurrent.futures 执行器，由调用者负责关闭
+    predistortion: 通道名到 Predistortion 的字典，相应通道的数据生成后在工作进程中作预失真
+
+    不给出 executor 时，第一次调用创建一个模块级的进程池（线程池），之后按 (threads, processes)
+    复用，避免每次都启动工作进程；它一直保留到解释器退出或调用 shutdownChannelExecutors 为止。
+    工作进程异常退出时丢弃该进程池，下次调用重新创建。
+
+    返回通道名到波形数据的字典，结果与逐个调用 generateData 相同。
+    使用进程池时，各通道的数据由工作进程直接写入同一块共享内存，不经 pickle 传回，
+    返回的数组是这块内存的视图（SharedArray）。
+    '''
+    names = list(waveforms)
+    sizes = [_Grid(waveforms[k]._domain[0], waveforms[k]._domain[1], 1.0/sampleRate).size
+             for k in names]
+    use_shm = not threads and shared_memory is not None and not isinstance(executor, ThreadPoolExecutor)
+    shared = executor is None
+    if shared:
+        executor = _channel_executor(threads, processes)
+    try:
+        if not use_shm:
+            futures = [executor.submit(_render_channel, waveforms[k] if threads else waveforms[k].to_spec(),
+                                       sampleRate, predistortion=predistortion.get(k)) for k in names]
+            return dict(zip(names, [f.result() for f in futures]))
+        offsets = np.cumsum([0] + sizes) * np.dtype(float).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+        try:
+            futures = [executor.submit(_render_channel, waveforms[k].to_spec(), sampleRate,
+                                       None, shm.name, int(o), predistortion.get(k))
+                       for k, o in zip(names, offsets)]
+            for f in futures:
+                f.result()
+        except BaseException:
+            shm.close()
+            raise
+        finally:
+            shm.unlink()
+        block = np.ndarray((int(offsets[-1]) // np.dtype(float).itemsize,), dtype=float,
+                           buffer=shm.buf).view(SharedArray)
+        block._shm = shm
+        return {k: block[o:o+n] for k, n, o in zip(names, sizes, offsets // np.dtype(float).itemsize)}
+    except BrokenExecutor:
+        if shared:
+            _channel_executors.pop((bool(threads), processes), None)
+        raise
+
+
+
+class IQWaveform():
+    '''用于 IQ 混频器的复波形 envelope * exp(1j*(w*t+phi))
+
+    envelope  : 实的包络波形，只计算一次
+    w, phi    : 角频率与相位，与 envelope*Cos(w, phi), envelope*Sin(w, phi) 对应
+    drag      : DRAG 系数，复包络为 envelope + 1j*drag*d(envelope)/dt
+    correction: 作用在 (I, Q) 上的 2x2 矩阵，用于修正 IQ 幅度不平衡与相位偏斜
+    offset    : (I, Q) 的直流偏置
+
+    I, Q 路在一次遍历中算出：只在包络不为零的区间内计算三角函数，
+    区间之外直接填充 offset。
+    '''
+    def __init__(self, envelope, w, phi=0, drag=0, correction=None, offset=(0, 0)):
+        self.envelope = envelope
+        self.w = w
+        self.phi = phi
+        self.drag = drag
+        self.correction = None if correction is None else np.asarray(correction, dtype=float)
+        self.offset = tuple(offset)
+
+    @staticmethod
+    def correction_matrix(gain=1.0, skew=0.0):
+        '''Q 路相对 I 路的增益为 gain、相位偏斜 skew 时的修正矩阵
+
+        混频器输出 (I, gain*(Q*cos(skew) + I*sin(skew)))，修正矩阵为其逆。
+        '''
+        return np.linalg.inv([[1, 0], [gain*np.sin(skew), gain*np.cos(skew)]])
+
+    def _key(self, sampleRate, dtype):
+        h = self.envelope.structural_hash()
+        if h is None:
+            return None
+        digest = hashlib.sha1(b'IQWaveform')
+        _update_digest(digest, (h, self.w, self.phi, self.drag, self.correction, self.offset))
+        return (digest.hexdigest(), sampleRate, self.envelope._domain, np.dtype(dtype).str)
+
+    def generateData(self, sampleRate, with_x=False, dtype='float32', cache=False):
+        '''生成 I, Q 两路数据，返回 (I, Q)，with_x 为真时返回 (x, I, Q)
+
+        cache 为真时使用 sample_cache，返回的总是只读数组
+        '''
+        x = np.arange(self.envelope._domain[0], self.envelope._domain[1], 1.0/sampleRate)
+        key = self._key(sampleRate, dtype) if cache else None
+        IQ = None if key is None else sample_cache.get(key)
+        if IQ is None:
+            IQ = self._render(x, sampleRate, dtype)
+            if key is not None:
+                sample_cache.put(key, IQ)
+            elif cache:
+                IQ.setflags(write=False)
+        if with_x:
+            return x, IQ[0], IQ[1]
+        return IQ[0], IQ[1]
+
+    def _render(self, x, sampleRate, dtype):
+        env = self.envelope.generateData(sampleRate, cache=False)
+        IQ = np.empty((2, len(x)), dtype=dtype)
+        IQ[0], IQ[1] = self.offset
+        nz = np.flatnonzero(env)
+        if len(nz) == 0:
+            return IQ
+        # DRAG 项的差分需要包络非零区间两侧各一个点
+        lo, hi = max(nz[0]-1, 0), min(nz[-1]+2, len(x))
+        e = env[lo:hi]
+        theta = self.w * x[lo:hi] + self.phi
+        c, s = np.cos(theta), np.sin(theta)
+        I, Q = e * c, e * s
+        if self.drag != 0 and len(env) > 1:
+            # 多取两侧各一点，使差分与在整个数组上计算的相同
+            a0, a1 = max(lo-1, 0), min(hi+1, len(x))
+            d = self.drag * np.gradient(env[a0:a1], 1.0/sampleRate)[lo-a0:hi-a0]
+            I -= d * s
+            Q += d * c
+        if self.correction is not None:
+            m = self.correction
+            I, Q = m[0, 0]*I + m[0, 1]*Q, m[1, 0]*I + m[1, 1]*Q
+        IQ[0, lo:hi] = I + self.offset[0]
+        IQ[1, lo:hi] = Q + self.offset[1]
+        return IQ
+
+
+class Predistortion():
+    '''通道的预失真：依次作用若干个指数修正的 IIR 滤波器和一个 FIR 滤波器
+
+    sampleRate  : 采样率
+    exponentials: [(A, tau), ...]，每一项修正阶跃响应为 1 + A*exp(-t/tau) 的失真
+    fir         : FIR 滤波器的系数
+
+    阶跃响应 s[n] = 1 + A*p**n (p = exp(-1/(sampleRate*tau))) 的离散系统为
+    H(z) = ((1+A) - (p+A)/z) / (1 - p/z)，修正滤波器取其逆。所有 IIR 节合并为
+    一次 sosfilt，FIR 部分由 signal.convolve 按长度选用直接或 FFT 卷积。两者的状态可以在分段之间传递，
+    分段计算的结果与一次计算的相同（FIR 部分相差舍入误差）。
+    '''
+    def __init__(self, sampleRate, exponentials=(), fir=None):
+        self.sampleRate = sampleRate
+        self.exponentials = [(float(A), float(tau)) for A, tau in exponentials]
+        self.fir = None if fir is None else np.asarray(fir, dtype=float)
+        sos = []
+        for A, tau in self.exponentials:
+            p = np.exp(-1/(sampleRate*tau))
+            sos.append([1/(1+A), -p/(1+A), 0, 1, -(p+A)/(1+A), 0])
+        self.sos = np.array(sos).reshape(-1, 6)
+
+    def structural_hash(self):
+        h = hashlib.sha1(b'Predistortion')
+        _update_digest(h, (self.sampleRate, self.exponentials, self.fir))
+        return h.hexdigest()
+
+    def initial_state(self):
+        '''返回零初始状态 (IIR 状态, FIR 尾部)'''
+        return np.zeros((len(self.sos), 2)), np.zeros(0 if self.fir is None else len(self.fir)-1)
+
+    def filter(self, y, state=None):
+        '''对一段数据作预失真，返回 (结果, 新状态)，state 为上一段返回的状态'''
+        zi, tail = self.initial_state() if state is None else state
+        if len(self.sos):
+            y, zi = signal.sosfilt(self.sos, y, zi=zi)
+        if self.fir is not None:
+            full = signal.convolve(y, self.fir) if len(y) else np.zeros(len(self.fir)-1)
+            # 上一段卷积超出其长度的部分（长 len(fir)-1）叠加到本段开头
+            full[:len(tail)] += tail
+            y, tail = full[:len(y)], full[len(y):]
+        return y, (zi, tail)
+
+    def apply(self, y):
+        return self.filter(np.asarray(y, dtype=float))[0]
+
+    def stream(self, chunks):
+        '''对依次给出的各段数据作预失真，在段之间传递滤波器的状态'''
+        state = None
+        for y in chunks:
+            y, state = self.filter(y, state)
+            yield y
+
+    def generateData(self, wav, with_x=False, cache=False, chunk=None):
+        '''生成 wav 的数据并作预失真，参数与 Waveform.generateData 相同
+
+        cache 为真时结果按 (波形的结构哈希, 预失真的哈希) 缓存在 sample_cache 中，
+        波形不变时不再重复滤波，返回的总是只读数组。
+        '''
+        if chunk is not None:
+            return self._generateChunks(wav, with_x, int(chunk))
+        key = wav.structural_hash() if cache else None
+        if key is not None:
+            key = (key, self.structural_hash(), self.sampleRate, wav._domain, 'float64')
+            y = sample_cache.get(key)
+            if y is None:
+                y = self.apply(wav.generateData(self.sampleRate, cache=False))
+                sample_cache.put(key, y)
+        else:
+            y = self.apply(wav.generateData(self.sampleRate, cache=False))
+            if cache:
+                y.setflags(write=False)
+        if with_x:
+            return np.arange(wav._domain[0], wav._domain[1], 1.0/self.sampleRate), y
+        return y
+
+    def _generateChunks(self, wav, with_x, chunk):
+        state = None
+        for data in wav.generateData(self.sampleRate, with_x=with_x, chunk=chunk):
+            if with_x:
+                x, y = data
+                y, state = self.filter(y, state)
+                yield x, y
+            else:
+                y, state = self.filter(data, state)
+                yield y
+
+
+__all__ = ['Waveform', 'DC', 'Interpolation', 'Step', 'Gaussian', 'Sin', 'Cos', 'Sinc',
+           'Operator', 'Sum', 'Product', 'Shift', 'Concat', 'Repeat', 'Overwrite', 'Param',
+           'SampleCache', 'sample_cache',
+           'SharedArray', 'generateChannels', 'shutdownChannelExecutors', 'IQWaveform', 'Predistortion']
 
 if __name__ == "__main__":
     w = (0.7*Step(0.7)<<1) - (0.2*Step(0.2)) - (0.5*Step(0)>>1)
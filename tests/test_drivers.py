@@ -0,0 +1,354 @@
+import importlib
+
+import numpy as np
+import pytest
+
+from qulab.util import IEEE_488_2_decode, IEEE_488_2_encode
+
+
+class FakeInstrument:
+    read_termination = '\n'
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.log = []
+        self.chunk = 1000
+
+    def write(self, message):
+        self.log.append(('write', message))
+
+    def query(self, message):
+        self.log.append(('query', message))
+        r = self.responses.get(message, '0')
+        if callable(r):
+            r = r()
+        return r
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list, delay=None):
+        return container([float(v) for v in self.query(message).split(separator)])
+
+    def write_raw(self, data):
+        data = bytes(data)
+        i = data.index(b'#')
+        self.log.append(('binary', data[:i].decode(), data[i:]))
+
+    def read_raw(self):
+        # 与 VISA 相同，读到结束符（二进制数据中也可能出现）或 chunk 字节为止
+        data = self.pending[:self.chunk]
+        if self.read_termination.encode() in data:
+            data = data[:data.index(self.read_termination.encode())+1]
+        self.pending = self.pending[len(data):]
+        return data
+
+    def close(self):
+        pass
+
+    def uploads(self, datatype='f'):
+        return [(r[0], r[1], IEEE_488_2_decode(r[2], datatype, False))
+                for r in self.log if r[0] == 'binary']
+
+
+@pytest.fixture
+def awg():
+    Driver = importlib.import_module('qulab.drivers.Tek_AWG').Driver
+    ins = FakeInstrument({'WLIS:LIST?': '"A"', 'SLIS:SIZE?': '0',
+                          'WLISt:WAVeform:TYPE? "A"': 'REAL\n',
+                          'WLIS:WAV:LENGTH? "A"': '100'})
+    awg = Driver(ins, model='AWG5208')
+    awg.performOpen()
+    return awg
+
+
+def test_awg_upload_cache(awg):
+    ins = awg.ins
+    data = np.sin(np.linspace(0, 1, 100))
+    awg.update_waveform(data, 'A')
+    awg.update_waveform(data.copy(), 'A')
+    assert len(ins.uploads()) == 1
+    awg.update_waveform(data[:50], 'A', start=50)
+    awg.update_waveform(data, 'A')
+    assert len(ins.uploads()) == 3
+
+    awg.create_waveform('B', 10)
+    assert awg.find_waveform(data) == 'A'
+    awg.update_waveform(np.zeros(10), 'B')
+    awg.update_waveform(np.zeros(10), 'B')
+    assert len(ins.uploads()) == 4
+    awg.remove_waveform('A')
+    assert awg.find_waveform(data) is None
+    awg.clear_waveform_list()
+    awg.create_waveform('B', 10)
+    awg.update_waveform(np.zeros(10), 'B')
+    assert len(ins.uploads()) == 5
+
+
+def test_awg_delta_upload(awg):
+    ins = awg.ins
+    awg.delta_min_gap = 5
+    data = np.zeros(100)
+    awg.update_waveform(data, 'A')
+    data[10:20] = 0.5
+    data[22:25] = 0.3
+    data[60] = -1
+    awg.update_waveform(data, 'A')
+    up = ins.uploads()[1:]
+    assert [r[1] for r in up] == ['WLIST:WAVEFORM:DATA:I "A",10,15,',
+                                  'WLIST:WAVEFORM:DATA:I "A",60,1,']
+    assert np.array_equal(up[0][2], data[10:25].astype('float32'))
+    awg.update_waveform(data[50:], 'A', start=50)
+    assert len(ins.uploads()) == 3
+    assert awg.find_waveform(data) == 'A'
+
+
+def test_awg_program_sequence(awg):
+    ins = awg.ins
+    awg.max_message_length = 1000
+    queue = []
+
+    def error():
+        # 模拟仪器的错误队列：重复次数为负、新建序列 T 时报错，
+        # 波形 A3 只在整批写入时报错
+        for r in ins.log[error.checked:]:
+            if r[0] != 'write':
+                continue
+            if ('RCO "S", -1' in r[1] or 'SEQ:NEW "T"' in r[1]
+                    or ('"A3"' in r[1] and ';' in r[1])):
+                queue.append('-222,"Data out of range"')
+        error.checked = len(ins.log)
+        return queue.pop(0) if queue else '0,"No error"'
+    error.checked = 0
+
+    ins.responses['SYST:ERR?'] = error
+    steps = [['A%d' % i, 'B%d' % i] for i in range(20)]
+    steps[15] = dict(sub_name=steps[15], repeat=-1)
+    errors = awg.program_sequence('S', steps)
+    writes = [r[1] for r in ins.log if r[0] == 'write']
+    assert writes[0] == 'SLIS:SEQ:NEW "S", 20, 2'
+    batches = [w for w in writes[1:] if ';' in w]
+    assert 1 < len(batches) < 20
+    assert all(len(w) <= 1000 for w in batches)
+    assert sum(w.count('WINP') for w in batches) == 20
+    assert [r[1] for r in ins.log].count('*OPC?') == len(batches) + 1
+    first = next(w for w in batches if '"A3"' in w)
+    n = first.count('WINP')
+    assert errors == {16: [(-222, 'Data out of range')],
+                      (1, n): [(-222, 'Data out of range')]}
+
+    del ins.log[:]
+    error.checked = 0
+    assert awg.program_sequence('T', steps) == {0: [(-222, 'Data out of range')]}
+    assert not any('STEP' in r[1] for r in ins.log)
+
+def test_awg_markers(awg):
+    Driver = importlib.import_module('qulab.drivers.Tek_AWG').Driver
+    ins = FakeInstrument({'WLIS:SIZE?': '0', 'WLISt:WAVeform:TYPE? "A"': 'INT\n',
+                          'WLIS:WAV:LENGTH? "A"': '8'})
+    awg5014 = Driver(ins, model='AWG5014C')
+    awg5014.performOpen()
+    data = np.linspace(-1, 1, 8)
+    mk1 = np.array([1, 1, 0, 0, 0, 0, 0, 0])
+    mk2 = np.array([0, 0, 0, 0, 1, 1, 1, 1])
+    awg5014.update_waveform(data, 'A', markers=(mk1, mk2))
+    up = ins.uploads('H')
+    assert len(up) == 1
+    values = up[0][2]
+    assert values.dtype == np.uint16
+    assert np.array_equal(values & 0x3fff, (data * 0x1fff).astype(int) + 0x1fff)
+    assert np.array_equal(values >> 14, mk1 + 2 * mk2)
+
+    awg.update_marker('A', mk1, None, mk2)
+    values = awg.ins.uploads('B')[-1][2]
+    assert values.dtype == np.uint8
+    assert np.array_equal(values, mk1 * 0x80 + mk2 * 0x20)
+
+
+def test_binary_block():
+    data = np.arange(-5, 5, dtype='int16')
+    header, payload = IEEE_488_2_encode(data, 'h', False)
+    assert header == '#220'
+    assert np.shares_memory(np.frombuffer(payload, 'int16'), data)
+    block = b'DATA ' + header.encode() + payload + b'\n'
+    assert np.array_equal(IEEE_488_2_decode(block, 'int16', False), data)
+    header, payload = IEEE_488_2_encode(data, 'float32', True)
+    assert bytes(payload) == data.astype('>f4').tobytes()
+    assert np.array_equal(IEEE_488_2_decode(b'#0' + bytes(payload) + b'\n', 'f', True), data)
+
+
+def test_driver_binary_values(awg):
+    ins = awg.ins
+    data = np.random.randn(1000)
+    header, payload = IEEE_488_2_encode(data, 'd', False)
+    ins.pending = header.encode() + bytes(payload) + b'\n'
+    res = awg.query_binary_values('CURV?', 'd', container=np.array)
+    assert isinstance(res, np.ndarray)
+    assert np.array_equal(res, data)
+    assert ins.pending == b''
+    # 头部与结束符分开到达时也要读完，下一次查询不受影响
+    for chunk in [1, 8000 + len(header)]:
+        ins.chunk = chunk
+        ins.pending = header.encode() + bytes(payload) + b'\n' + b'#14abcd\n'
+        assert np.array_equal(awg.query_binary_values('CURV?', 'd', container=np.array), data)
+        assert ins.pending == b'#14abcd\n'
+    assert list(awg.query_binary_values('CURV?', 'B')) == list(b'abcd')
+    with pytest.raises(ValueError):
+        awg.query_binary_values('CURV?', 'd', header_fmt='hp')
+    awg.write_binary_values('DATA ', data, 'f')
+    assert ins.log[-1][1] == 'DATA '
+    assert np.array_equal(ins.uploads()[-1][2], data.astype('float32'))
+
+
+def test_set_value_cache(awg):
+    ins = awg.ins
+    ins.responses['SOURCE1:VOLT?'] = '0.5'
+
+    def writes():
+        return [r[1] for r in ins.log if r[0] == 'write']
+
+    for i in range(10):
+        awg.setValue('Vpp', 0.5, channel=i % 2 + 1)
+    assert writes() == ['SOURCE1:VOLT 0.500000', 'SOURCE2:VOLT 0.500000']
+    awg.setValue('Vpp', 0.5, channel=1, force=True)
+    assert len(writes()) == 3
+    assert awg.getValue('Vpp', channel=1) == 0.5
+    awg.setValue('Vpp', 0.5, channel=1)
+    assert len(writes()) == 3
+
+    awg.write('*RST')
+    awg.setValue('Vpp', 0.5, channel=1)
+    assert len(writes()) == 5
+    ins.responses['SOURCE1:VOLT?'] = '0.3'
+    awg.getValue('Vpp', channel=1)
+    awg.setValue('Vpp', 0.5, channel=1)
+    assert len(writes()) == 6
+    ins.responses['SYST:ERR?'] = ['0,"No error"\n', '-222,"Data out of range"\n'].pop
+    awg.errors()
+    awg.setValue('Vpp', 0.5, channel=1)
+    assert len(writes()) == 7
+
+
+def test_driver_batch(awg):
+    ins = awg.ins
+    ins.responses['SYST:ERR?'] = '0,"No error"\n'
+    awg.max_message_length = 50
+    del ins.log[:]
+    with awg.batch():
+        awg.setValue('Run Mode', 'Triggered')
+        awg.setValue('Clock Source', 'External')
+        with awg.batch():
+            awg.write('*CLS')
+        awg.setValue('Reference Source', 'External')
+        assert ins.log == []
+        awg.query('*OPC?')
+        awg.setValue('Sample Rate', 1e9)
+    assert [r[1] for r in ins.log] == [
+        'AWGC:RMOD TRIG;:AWGC:CLOC:SOUR EXT;*CLS',
+        'SOUR:ROSC:SOUR EXT', 'SYST:ERR?', '*OPC?',
+        'SOUR:FREQ 1000000000.000000', 'SYST:ERR?']
+
+
+def test_non_scpi_commands():
+    # SR620 的命令不能用 ';:' 连接，init 与 getValues 逐条发送
+    Driver = importlib.import_module('qulab.drivers.SR620').Driver
+    ins = FakeInstrument({'LEVL? 0': '0.5\n', 'LEVL? 1': '0.25\n'})
+    sr = Driver(ins, model='SR620')
+    sr.init({'Ext Level': 0.5, 'A Level': 0.25, 'Mode': 'time'})
+    assert [r[1] for r in ins.log] == ['LEVL 0,0.500000', 'LEVL 1,0.250000', 'MODE 0']
+    del ins.log[:]
+    assert sr.getValues(['Ext Level', 'A Level']) == [0.5, 0.25]
+    assert [r[1] for r in ins.log] == ['LEVL? 0', 'LEVL? 1']
+
+
+def test_get_values():
+    Driver = importlib.import_module('qulab.drivers.DPO4104B').Driver
+    ins = FakeInstrument({
+        ':WFMI:YOF?;:WFMI:YMU?;:WFMI:YZER?;:WFMI:XIN?;:WFMI:XZER?;:CH2:POS?;:CH2:SCA?':
+        '1.0E0;4.0E-3;0.0E0;1.0E-9;-5.0E-6;2.0E0;5.0E-1\n',
+        'CURV?': '1,2,3'})
+    dpo = Driver(ins, model='DPO4104B')
+    x, y = dpo.get_Trace(ch=2, start=1, stop=3)
+    assert sum(r[0] == 'query' for r in ins.log) == 2
+    assert np.allclose(x, [-5e-6, -5e-6 + 1e-9, -5e-6 + 2e-9])
+    assert np.allclose(y, ((np.array([1, 2, 3]) - 1) * 4e-3 * 10 - 2) * 0.5)
+
+    ins.responses[':WFMI:XIN?'] = '1.0E-9'
+    ins.responses['WFMI:BYT_N?'] = '2'
+    assert dpo.getValues(['X Step', 'Bytes per Point']) == [1e-9, 2]
+    assert not dpo.chain_queries
+    assert dpo.getValues(['X Step']) == [1e-9]
+    assert ins.log[-1] == ('query', ':WFMI:XIN?')
+
+    # I/O 错误不关闭合并查询
+    dpo = Driver(ins, model='DPO4104B')
+
+    def timeout():
+        raise TimeoutError('VI_ERROR_TMO')
+    ins.responses[':WFMI:XIN?;:WFMI:XZER?'] = timeout
+    with pytest.raises(TimeoutError):
+        dpo.getValues(['X Step', 'X Zero'])
+    assert dpo.chain_queries
+    ins.responses[':WFMI:XIN?;:WFMI:XZER?'] = '1.0E-9;-5.0E-6\n'
+    assert dpo.getValues(['X Step', 'X Zero']) == [1e-9, -5e-6]
+
+
+def test_driver_async():
+    import asyncio
+    import threading
+
+    Driver = importlib.import_module('qulab.drivers.DPO4104B').Driver
+    ready = threading.Event()
+
+    class SlowInstrument(FakeInstrument):
+        def query(self, message):
+            self.thread = threading.current_thread()
+            if message == 'WAIT?':
+                # 另一台仪器的命令执行后才能返回，两者必须并行
+                assert ready.wait(5)
+            return super().query(message)
+
+        def write(self, message):
+            self.thread = threading.current_thread()
+            ready.set()
+            super().write(message)
+
+    a = Driver(SlowInstrument({':WFMI:XIN?': '1.0E-9'}), model='DPO4104B')
+    b = Driver(SlowInstrument(), model='DPO4104B')
+
+    async def main():
+        return await asyncio.gather(a.aquery('WAIT?'), b.awrite('*CLS'),
+                                    a.agetValue('X Step'), b.asetValue('X Step', 2e-9))
+
+    loop = asyncio.new_event_loop()
+    try:
+        res = loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert res[0] == '0' and res[2] == 1e-9
+    assert a.ins.thread is not b.ins.thread
+    assert a.ins.thread is not threading.current_thread()
+    assert b.ins.log == [('write', '*CLS'), ('write', ':WFMI:XIN 2.000000e-09')]
+    a.close()
+    b.close()
+
+
+def test_awg_upload_waveform(awg, monkeypatch):
+    from qulab.waveform import Gaussian, Waveform
+
+    Driver = importlib.import_module('qulab.drivers.Tek_AWG').Driver
+    ins = FakeInstrument({'WLIS:SIZE?': '0', 'WLISt:WAVeform:TYPE? "A"': 'INT\n',
+                          'WLIS:WAV:LENGTH? "A"': '100', 'SOUR:FREQ?': '1e9'})
+    awg5014 = Driver(ins, model='AWG5014C')
+    awg5014.performOpen()
+    awg.ins.responses['SOUR:FREQ?'] = '1e9'
+    w = (Gaussian(10e-9) >> 50e-9).set_range(0, 100e-9)
+    data = w.generateData(1e9)
+
+    def fail(*args, **kw):
+        raise AssertionError('should render with generateSamples')
+    monkeypatch.setattr(Waveform, 'generateData', fail)
+    for drv, datatype in [(awg5014, 'H'), (awg, 'f')]:
+        drv.update_waveform(w, 'A')
+        drv.ins.responses['WLISt:WAVeform:TYPE? "B"'] = drv._waveform_type('A')
+        drv.ins.responses['WLIS:WAV:LENGTH? "B"'] = '100'
+        drv.update_waveform(data, 'B')
+        up = drv.ins.uploads(datatype)
+        assert np.array_equal(up[-2][2], up[-1][2])
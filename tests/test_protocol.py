@@ -10,3 +10,18 @@ def test_transport():
     assert d1[0] == d2[0]
     assert d1[1] == d2[1]
     assert np.all(d1[2] == d2[2])
+
+
+def test_transport_waveform():
+    from qulab.waveform import Waveform, Gaussian, Cos, DC, Param
+
+    t = Transport()
+    w = (((Gaussian(10e-9) >> 20e-9) * Cos(2e8) | DC(0.5, 1e-6)) ^ 10).set_range(0, 20e-6)
+    w = w * Param('amp', 0.8)
+    s = t.encode(w)
+    assert len(s) < 2000
+    assert len(s) < w.generateData(1e9).nbytes / 100
+    assert np.array_equal(t.decode(s).generateData(1e9), w.generateData(1e9))
+    v = Waveform.from_json(w.to_json())
+    assert v.structural_hash() == w.structural_hash()
+    assert np.array_equal(v.generateData(1e9), w.generateData(1e9))
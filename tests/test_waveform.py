@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from qulab.waveform import *
@@ -6,3 +7,337 @@ from qulab.waveform import *
 def test_waveform():
     w = (0.7 * Step(0.7) << 1) - (0.2 * Step(0.2)) - (0.5 * Step(0.5) >> 1)
     assert isinstance(w, Waveform)
+
+
+def test_long_concat():
+    pulse = Gaussian(0.3)
+    w = pulse
+    for i in range(2000):
+        w = w | pulse
+    x, y = w.generateData(100, with_x=True)
+    assert len(y) == len(x)
+    assert np.allclose(y[:30], pulse.generateData(100))
+    assert np.allclose(y[30:60], pulse.generateData(100))
+
+
+def test_deep_nesting():
+    # 右深的长链按 Sethi–Ullman 顺序展开，临时缓冲区的数目与深度无关
+    pulse = Gaussian(0.3) >> 0.5
+    left = right = Cos(2 * np.pi)
+    for i in range(2000):
+        left = left - 0.001 * i * pulse
+        right = 0.001 * i * pulse - right
+    assert left._compile().nregs <= 2
+    assert right._compile().nregs <= 2
+    y = right.set_range(0, 1).generateData(100, cache=False)
+    p = (1 * pulse).set_range(0, 1).generateData(100)
+    c = Cos(2 * np.pi).set_range(0, 1).generateData(100)
+    assert np.allclose(y, 0.001 * sum(i * (-1)**(1999 - i) for i in range(2000)) * p + c)
+
+
+def test_overwrite():
+    # other 的定义域内（含端点）取 other 的值，之外取 wav 的值
+    w = DC(1, 1).overwrite((2 * Cos(0)).set_range(0.25, 0.5)).set_range(0, 1)
+    x, y = w.generateData(20, with_x=True)
+    inside = (x >= 0.25) & (x <= 0.5)
+    assert np.array_equal(y[inside], np.full(inside.sum(), 2.0))
+    assert np.array_equal(y[~inside & (x > 0)], np.ones((~inside & (x > 0)).sum()))
+    assert np.array_equal(w(np.array([0.25, 0.5, 0.75])), [2, 2, 1])
+
+
+def test_call():
+    w = (0.5 * Gaussian(0.3) >> 0.2) + Cos(2 * np.pi)
+    x = np.array([0.3, 0.1, 0.2])
+    assert np.allclose(w(x), 0.5 * np.exp(-0.5 * ((x - 0.2) / (0.3 / (4 * np.sqrt(2 * np.log(2)))))**2) + np.cos(2 * np.pi * x))
+
+
+@pytest.mark.parametrize('wav', [
+    Gaussian(0.02) >> 30, Step(0.02) >> 30, Step(0) >> 30,
+    DC(0.5, 0.02) >> 30,
+    Interpolation([0, 0.01, 0.02], [0, 1, 0.5]) >> 30
+])
+def test_sparse_evaluation(wav):
+    x, y = wav.set_range(0, 100).generateData(1000, with_x=True)
+    leaf = wav.wav
+    t = x - 30
+    if leaf._timeFunc_domain == (-np.inf, np.inf):
+        expected = leaf.timeFunc(t)
+    else:
+        expected = leaf._timeFunc(t)
+    assert np.all(y == expected)
+
+
+@pytest.mark.parametrize('wav', [Step(-0.2), Gaussian(-0.2), Step(-0.2) >> 0.3,
+                                 (Gaussian(-0.2) >> 0.1) * Cos(3) + Step(-0.1)])
+def test_negative_width(wav):
+    # 宽度为负时 Step 是下降沿，Gaussian 与宽度为正时相同
+    x, y = wav.set_range(-1, 1).generateData(10, with_x=True, cache=False)
+    assert np.array_equal(y, wav(x))
+    step, gauss = Step(-0.2).set_range(-1, 1), Gaussian(-0.2).set_range(-1, 1)
+    assert np.array_equal(step.generateData(10, cache=False), step.timeFunc(x))
+    assert np.array_equal(gauss.generateData(10, cache=False), gauss.timeFunc(x))
+    assert gauss.generateData(10, cache=False).max() == 1.0
+
+
+def test_sparse_operands():
+    # 和与积中的脉冲只在其支撑集内逐点计算，每个脉冲的开销与波形总长度无关
+    from qulab.waveform import _FILL, _window_index
+
+    def work(w, sampleRate):
+        x = w.generateData(sampleRate, with_x=True, cache=False)[0]
+        return sum(np.subtract(*_window_index(x, op[1])[::-1])
+                   for op in w._compile().ops if op[0] != _FILL)
+
+    w = 0
+    for k in range(10):
+        w = w + ((Gaussian(2e-3) >> (0.05 + 0.09 * k)) * Cos(2 * np.pi * 500))
+    short, long = w.set_range(0, 1), w.set_range(0, 100)
+    assert work(short, 1e4) == work(long, 1e4) < 1e6 / 50
+    x = np.arange(0, 100, 1e-4)
+    y = long.generateData(1e4)
+    assert np.array_equal(y[x >= 1], np.zeros(np.sum(x >= 1)))
+    assert np.allclose(y[x < 1], sum(((Gaussian(2e-3) >> (0.05 + 0.09 * k)) * Cos(2 * np.pi * 500))(x[x < 1])
+                                     for k in range(10)))
+
+
+@pytest.mark.parametrize('sampleRate', [100.0, 137.0])
+def test_repeat(sampleRate):
+    pulse = Gaussian(0.3) | DC(0.2, 0.1)
+    w = pulse ^ 1000
+    assert isinstance(w, Repeat)
+    assert w.len() == pytest.approx(1000 * pulse.len())
+    x, y = w.generateData(sampleRate, with_x=True)
+    assert np.allclose(y, w._compile().execute(x))
+    t = x[x >= 500 * pulse.len()][:20]
+    assert np.allclose(w(t), pulse(t - 500 * pulse.len()))
+
+
+def test_shifted_concat_and_repeat():
+    # 平移后的波形在 Concat 与 Repeat 中只平移一次
+    G, D = Gaussian(0.2), DC(1, 0.2)
+    g = G >> 0.3
+    w = g | (D >> 0.1)
+    x, y = w.generateData(20, with_x=True)
+    expected = np.where(x < 0.4, G.timeFunc(x - 0.3), D.timeFunc(x - 0.4))
+    assert np.allclose(y, expected)
+    assert np.allclose(w(x), expected)
+
+    w = g ^ 3
+    x, y = w.generateData(20, with_x=True)
+    k = np.floor((x - 0.2) / 0.2 + 1e-9)
+    expected = G.timeFunc(x - 0.2 * k - 0.3)
+    assert y.max() == 1.0
+    assert np.allclose(y, expected)
+    assert np.allclose(w(x), expected)
+
+
+def test_sample_cache():
+    sample_cache.clear()
+
+    def sweep_point(amp):
+        return (Gaussian(0.3) | (amp * Gaussian(0.2)) | DC(0.5, 0.1)) + Cos(2 * np.pi)
+
+    y1 = sweep_point(0.5).generateData(100, cache=True)
+    assert sample_cache.info()['misses'] == 1
+    y2 = sweep_point(0.5).generateData(100, cache=True)
+    assert sample_cache.info()['hits'] == 1
+    assert np.all(y1 == y2)
+    y3 = sweep_point(0.6).generateData(100, cache=True)
+    assert sample_cache.info()['misses'] == 2
+    assert not np.all(y1 == y3)
+    assert sweep_point(0.5).structural_hash() != (sweep_point(0.5) >> 1).structural_hash()
+
+    w = Waveform()
+    assert w.structural_hash() is None
+    assert not w.generateData(100, cache=True).flags.writeable
+    assert sample_cache.info()['misses'] == 2
+    # 默认不使用缓存，返回的数组可以直接修改
+    assert sweep_point(0.5).generateData(100).flags.writeable
+    assert sample_cache.info()['hits'] == 1
+
+    cache = SampleCache(maxbytes=1000)
+    cache.put('a', np.zeros(100))
+    cache.put('b', np.zeros(100))
+    assert len(cache) == 1 and cache.get('a') is None
+    y = np.zeros(10)
+    cache.put('c', y)
+    assert cache.get('c') is y and not y.flags.writeable
+    y = np.zeros(1000)
+    cache.put('d', y)
+    assert cache.get('d') is None and not y.flags.writeable
+
+    # 修改子树后父节点的哈希随之改变，不会取到过期的数据
+    a = DC(1, 0.3)
+    c = a | DC(2, 0.3)
+    c.generateData(100, cache=True)
+    a.set_range(0, 0.5)
+    assert np.array_equal(c.generateData(100, cache=True), c.generateData(100))
+
+
+def test_generate_batch():
+    amp, width, t, phi = Param('amp', 1), Param('width', 0.1), Param('t'), Param('phi')
+    template = ((amp * Gaussian(width) >> t) * Cos(20 * np.pi, phi)).set_range(-1, 2)
+    A = np.linspace(0, 1, 5)
+    W = np.linspace(0.05, 0.3, 5)
+    T = np.linspace(0.2, 1.0, 5)
+    Y = template.generateBatch(100, amp=A, width=W, t=T, phi=0.5)
+    assert Y.shape == (5, 300)
+    for i in range(5):
+        w = ((A[i] * Gaussian(W[i]) >> T[i]) * Cos(20 * np.pi, 0.5)).set_range(-1, 2)
+        assert np.allclose(Y[i], w.generateData(100))
+    assert np.all(template.generateData(100) == template.generateBatch(100)[0])
+
+
+def test_chunked_generation():
+    w = (((Gaussian(0.3) | DC(0.2, 0.1)) ^ 50) + Cos(3)).set_range(-1, 21)
+    for sampleRate in [100.0, 137.0]:
+        y = w.generateData(sampleRate, cache=False)
+        for chunk in [1, 7, 1000]:
+            assert np.array_equal(y, np.concatenate(list(w.generateData(sampleRate, chunk=chunk))))
+
+
+def test_generate_samples():
+    w = ((Gaussian(0.3) | DC(0.5, 0.2)) ^ 30) * Cos(20)
+    marker = DC(1, 0.2) >> 0.1
+    x, y = w.generateData(1000, with_x=True)
+    s = w.generateSamples(1000, 'uint16', scale=0x1fff, offset=0x1fff,
+                          clip=(-0x1fff, 0x1fff), markers={14: marker}, chunk=999)
+    assert s.dtype == np.uint16
+    assert np.array_equal(s & 0x3fff, (y.clip(-1, 1) * 0x1fff).astype(int) + 0x1fff)
+    assert np.array_equal(s >> 14, marker(x) != 0)
+    assert np.array_equal(w.generateSamples(1000, 'float32'), y.astype(np.float32))
+
+
+def test_spec_and_pickle():
+    import pickle
+    w = ((Gaussian(0.3) | DC(0.5, 0.2) | Interpolation([0, 0.5, 1], [0, 1, 0])) ^ 3) * Cos(20, 0.1)
+    w = (w + (Step(0.01) >> 0.4) - Sinc(5) / 2).set_range(-1, 4)
+    for v in [Waveform.from_spec(w.to_spec()), pickle.loads(pickle.dumps(w))]:
+        assert v.structural_hash() == w.structural_hash()
+        assert np.array_equal(v.generateData(100, cache=False), w.generateData(100, cache=False))
+    chain = Gaussian(0.1)
+    for i in range(3000):
+        chain = chain | Gaussian(0.1)
+    assert pickle.loads(pickle.dumps(chain)).len() == chain.len()
+
+
+def test_generate_channels():
+    wavs = {'Q%d' % i: ((Gaussian(0.1) >> 0.1 * i) * Cos(20) + DC(0.1, 0.5)).set_range(-1, 2)
+            for i in range(4)}
+    from qulab.waveform import _channel_executors
+
+    shutdownChannelExecutors()
+    for kw in [{'processes': 2}, {'threads': True}]:
+        data = generateChannels(wavs, 100, **kw)
+        for k, w in wavs.items():
+            assert np.array_equal(data[k], w.generateData(100, cache=False))
+    # 默认的进程池在多次调用之间复用
+    pools = dict(_channel_executors)
+    assert len(pools) == 2
+    data = generateChannels(wavs, 100, processes=2)
+    assert np.array_equal(data['Q1'], wavs['Q1'].generateData(100))
+    assert _channel_executors == pools
+    shutdownChannelExecutors()
+    assert not _channel_executors
+
+
+@pytest.mark.parametrize('kind', ['linear', 'cubic', 'nearest'])
+def test_interpolation(kind):
+    from scipy.interpolate import interp1d
+
+    xp = np.linspace(0, 1, 11) ** 2
+    yp = np.cos(7 * xp)
+    w = (Interpolation(xp, yp, kind) >> 0.25).set_range(-1, 2)
+    x, y = w.generateData(100, with_x=True, cache=False)
+    t = x - 0.25
+    mask = (t > 0) & (t < 1)
+    assert np.all(y[~mask] == 0)
+    assert np.allclose(y[mask], interp1d(xp, yp, kind=kind)(t[mask]), rtol=0, atol=1e-12)
+
+
+def test_nary_operators():
+    tones = [0.1 * (i + 1) * Cos(2 * np.pi * (1 + 0.1 * i)) for i in range(20)]
+    w = sum(tones).set_range(0, 10)
+    assert isinstance(w, Sum) and len(w.operands) == 20
+    x, y = w.generateData(100, with_x=True)
+    assert np.allclose(y, sum(0.1 * (i + 1) * np.cos(2 * np.pi * (1 + 0.1 * i) * x) for i in range(20)))
+    assert w._compile().nregs == 2
+
+    g = Gaussian(1)
+    assert (g + 1 + 2).operands == (g, 3)
+    assert (2 * (3 * g) * 0.5).operands == (g, 3.0)
+    assert (g + 0 + g).operands == (g, g)
+    p = Param('a', 2)
+    assert (p * g * 2 * 3).operands == (p, g, 6)
+    assert np.allclose((p * g * 2).generateBatch(10, a=[1, 2])[1], (4 * g).generateData(10))
+    h = (g + g).set_range(-5, 5)
+    assert len((h + g).operands) == 2
+
+
+def test_spectrum():
+    f = np.linspace(-3, 3, 13) + 0.013
+    for w in [(Gaussian(1) >> 0.7) * Cos(2 * np.pi * 1.5, 0.3),
+              Step(0.5) - (Step(0.5) >> 3) + 2 * (Gaussian(2) >> 1) * Sin(6, 1),
+              (Gaussian(1) >> 0.7) / 2]:
+        x, y = w.set_range(-20, 20).generateData(200, with_x=True)
+        F = [np.sum(y * np.exp(-2j * np.pi * fi * x)) / 200 for fi in f]
+        assert np.allclose(w.spectrum(f), F, rtol=0, atol=1e-9)
+    assert np.allclose(DC(2, range=(0.5, 1.5)).spectrum([0, 0.5]), [2, 4 / np.pi * np.exp(-1j * np.pi)])
+    assert (3 * Cos(2 * np.pi) + 1).spectrum_lines() == [(-1.0, 1.5), (0.0, 1.0), (1.0, 1.5)]
+    assert (Cos(2 * np.pi) / 4).spectrum_lines() == [(-1.0, 0.125), (1.0, 0.125)]
+    with pytest.raises(TypeError):
+        (Gaussian(1) | Gaussian(1)).spectrum(f)
+
+
+def test_predistortion():
+    from scipy import signal
+
+    sampleRate = 1e9
+    pd = Predistortion(sampleRate, [(0.05, 200e-9), (-0.02, 30e-9)], fir=[0.9, 0.08, 0.02])
+    w = DC(1, range=(10e-9, 2e-6)).set_range(0, 4e-6)
+    y = pd.generateData(w)
+    # 依次作用失真模型和 FIR 的逆，应还原出原来的波形
+    z = y
+    for A, tau in pd.exponentials:
+        p = np.exp(-1 / (sampleRate * tau))
+        z = signal.lfilter([1 + A, -(p + A)], [1, -p], z)
+    z = signal.lfilter([1], pd.fir, z)
+    assert np.allclose(z, w.generateData(sampleRate), atol=1e-12)
+    for chunk in [1, 7, 1000]:
+        assert np.allclose(np.concatenate(list(pd.generateData(w, chunk=chunk))), y, rtol=0, atol=1e-14)
+    hits = sample_cache.hits
+    pd.generateData(w, cache=True)
+    assert np.array_equal(pd.generateData(w, cache=True), y)
+    assert sample_cache.hits == hits + 1
+
+
+def test_iq_waveform():
+    env = (Gaussian(0.2) >> 0.5).set_range(0, 2)
+    w, phi = 2 * np.pi * 10, 0.3
+    I, Q = IQWaveform(env, w, phi).generateData(1000)
+    assert I.dtype == Q.dtype == np.float32
+    assert np.allclose(I, (env * Cos(w, phi)).generateData(1000), atol=1e-6)
+    assert np.allclose(Q, (env * Sin(w, phi)).generateData(1000), atol=1e-6)
+
+    M = IQWaveform.correction_matrix(1.1, 0.05)
+    x, I, Q = IQWaveform(env, w, phi, drag=0.01, correction=M, offset=(0.1, 0)).generateData(1000, with_x=True)
+    e = env.generateData(1000)
+    z = (e + 1j * 0.01 * np.gradient(e, 1e-3)) * np.exp(1j * (w * x + phi))
+    # 经过有幅度不平衡和相位偏斜的混频器后得到期望的 I, Q
+    I = I - 0.1
+    assert np.allclose(I, z.real, atol=1e-6)
+    assert np.allclose(1.1 * (Q * np.cos(0.05) + I * np.sin(0.05)), z.imag, atol=1e-6)
+
+
+def test_piecewise_constant():
+    w = (DC(1, range=(0.1, 5)) + (DC(0.2, range=(1, 2)) >> 0.013) - 0.3 * (Step(0) >> 3)) | DC(0.5, 0.25)
+    w = w.overwrite(DC(-1, range=(4, 4.5))).set_range(0, 8)
+    assert w.segments() == [(0, 0.1, 0.0), (0.1, 1.013, 1.0), (1.013, 2.013, 1.2), (2.013, 3, 1.0),
+                            (3, 4, 0.7), (4, 4.5, -1.0), (4.5, 5, 0.7), (5, 5.25, 0.5), (5.25, 8, 0.0)]
+    for sampleRate in [100.0, 137.0]:
+        y = w.generateData(sampleRate, cache=False)
+        runs = w.runs(sampleRate)
+        assert np.array_equal(np.repeat([v for v, n in runs], [n for v, n in runs]), y)
+        assert np.array_equal(np.concatenate(list(w.generateData(sampleRate, chunk=17))), y)
+    with pytest.raises(TypeError):
+        (DC(1, 1) + Gaussian(1)).runs(100)